@@ -1,9 +1,12 @@
+import itertools
 import sqlite3
 
+import numpy as np
 from trafficintelligence import moving
 from trafficintelligence.storage import printDBError
 
 import events
+import indicators
 import toolkit
 
 
@@ -14,7 +17,9 @@ class Analysis:
         # self.interactions = world.completedInteractions
         self.analysisZone = analysisZone
         self.seed = seed
-        if saveAllInteractions:
+        if world is None:  # only used to format rows (see network.SqliteSink)
+            self.interactions = []
+        elif saveAllInteractions:
             self.interactions = world.completedInteractions + world.completedInteractions
         else:
             self.interactions = world.completedInteractions
@@ -55,22 +60,21 @@ class Analysis:
             cursor.execute(query, values)
         connection.commit()
 
-    def saveIndicatorsToSqlite(self, filename, interactions, indicatorNames=events.Interaction.indicatorNames):
-        'Saves the indicator values in the table'
+    def saveIndicatorsToSqlite(self, filename, interactions, indicatorNames=events.Interaction.indicatorNames, journalMode=None, synchronous=None):
+        'Saves the indicator values in the table, in a single transaction'
         with sqlite3.connect(filename) as connection:
+            toolkit.setSqlitePragmas(connection, journalMode, synchronous)
             cursor = connection.cursor()
             try:
                 self.createInteractionTable(cursor)
                 self.createIndicatorTable(cursor)
-                for inter in interactions:
-                    self.saveInteraction(cursor, inter)
-                    for indicatorName in indicatorNames:
-                        indicator = inter.getIndicator(indicatorName)
-                        if indicator is not None:
-                           self.saveIndicator(cursor, inter.getNum(), indicator)
+                cursor.executemany(self.interactionQuery, (self.getInteractionRow(inter) for inter in interactions))
+                cursor.executemany(self.indicatorQuery, itertools.chain.from_iterable(self.getIndicatorRows(inter.getNum(), inter.getIndicator(indicatorName))
+                                                                                      for inter in interactions for indicatorName in indicatorNames if inter.getIndicator(indicatorName) is not None))
             except sqlite3.OperationalError as error:
                 printDBError(error)
             connection.commit()
+        connection.close()
 
     def createInteractionTable(self, cursor):
         cursor.execute('CREATE TABLE IF NOT EXISTS interactions (id INTEGER, analysis_id INTEGER, seed INTEGER, object_id1 INTEGER, object_id2 INTEGER, first_frame_number INTEGER, last_frame_number INTEGER, FOREIGN KEY(object_id1) REFERENCES objects(id), PRIMARY KEY(id, analysis_id, seed), FOREIGN KEY(object_id2) REFERENCES objects(id))')
@@ -78,15 +82,37 @@ class Analysis:
     def createIndicatorTable(self, cursor):
         cursor.execute('CREATE TABLE IF NOT EXISTS indicators (interaction_id INTEGER, analysis_id INTEGER, seed INTEGER, indicator_type INTEGER, frame_number INTEGER, value REAL, FOREIGN KEY(interaction_id) REFERENCES interactions(id), PRIMARY KEY(interaction_id, analysis_id, seed, indicator_type, frame_number))')
 
-    def saveInteraction(self, cursor, interaction):
+    interactionQuery = 'INSERT INTO interactions VALUES(?, ?, ?, ?, ?, ?, ?)'
+    indicatorQuery = 'INSERT INTO indicators VALUES(?, ?, ?, ?, ?, ?)'
+
+    def getInteractionRow(self, interaction):
         roadUserNumbers = list(interaction.getRoadUserNumbers())
         # category = interaction.categoryNum
-        cursor.execute('INSERT INTO interactions VALUES({}, {}, {}, {}, {}, {}, {})'.format(interaction.getNum(), self.idx, self.seed, roadUserNumbers[0], roadUserNumbers[1], interaction.getFirstInstant(), interaction.getLastInstant()))
+        return (interaction.getNum(), self.idx, self.seed, roadUserNumbers[0], roadUserNumbers[1], interaction.getFirstInstant(), interaction.getLastInstant())
 
-    def saveIndicator(self, cursor, interactionNum, indicator):
+    def getIndicatorRows(self, interactionNum, indicator):
+        indicatorType = events.Interaction.indicatorNameToIndices[indicator.getName()]
         for instant in indicator.getTimeInterval():
-            if indicator[instant]:
-                cursor.execute('INSERT INTO indicators VALUES({}, {}, {}, {}, {}, {})'.format(interactionNum, self.idx, self.seed, events.Interaction.indicatorNameToIndices[indicator.getName()], instant, indicator[instant]))
+            value = indicator[instant]
+            if value:
+                yield (interactionNum, self.idx, self.seed, indicatorType, instant, float(value))
+
+    def saveInteraction(self, cursor, interaction):
+        cursor.execute(self.interactionQuery, self.getInteractionRow(interaction))
+
+    def saveIndicator(self, cursor, interactionNum, indicator):
+        cursor.executemany(self.indicatorQuery, self.getIndicatorRows(interactionNum, indicator))
+
+
+def getIndicatorSummaries(interactions, indicatorName, minNInstants=1, centiles=[], threshold=None):
+    '''returns the summaries of the indicator indicatorName of the interactions, computed in one vectorised pass
+    (see indicators.getSeveritySummaries): arrays of the most severe values, of their instants,
+    of the centiles and of the number of values smaller than or equal to threshold, one item per interaction
+    (the indicators must have the same mostSevereIsMax)'''
+    indicatorList = [inter.getIndicator(indicatorName) for inter in interactions]
+    mostSevereIsMax = next((indicator.mostSevereIsMax for indicator in indicatorList if indicator is not None), False)
+    assert all(indicator.mostSevereIsMax == mostSevereIsMax for indicator in indicatorList if indicator is not None), 'the indicators {} do not have the same mostSevereIsMax'.format(indicatorName)
+    return indicators.getSeveritySummaries(indicatorList, mostSevereIsMax, minNInstants, centiles, threshold)
 
 
 class AnalysisZone:
@@ -99,6 +125,16 @@ class AnalysisZone:
             self.minAlignment.append([entryAlignment.getTotalDistance() - self.area ** .5, entryAlignment.idx])
         for exitAlignment in intersection.exitAlignments:
             self.maxAlignment.append([self.area ** .5, exitAlignment.idx])
+        self.initBounds()
+
+    def initBounds(self):
+        """precomputes the bounds of the zone on each alignment:
+        minimum curvilinear coordinate on the entry alignments, maximum on the exit alignments"""
+        self.minCoordinates = {}
+        self.maxCoordinates = {}
+        for minVal, maxVal in zip(self.minAlignment, self.maxAlignment):
+            self.minCoordinates[minVal[1]] = minVal[0]
+            self.maxCoordinates[maxVal[1]] = maxVal[0]
 
     def getLimits(self):
         """return limits of analysis zone"""
@@ -114,38 +150,255 @@ class AnalysisZone:
 
     def userInAnalysisZoneAtInstant(self, user, t):
         """determines if a user is inside a predetermined analysis zone"""
-        if t in list(user.timeInterval):
-            cp = user.getCurvilinearPositionAtInstant(t)
-            for minVal, maxVal in zip(self.minAlignment, self.maxAlignment):
-                if (minVal[0] <= cp[0] and cp[2] == minVal[1]) or (cp[0] <= maxVal[0] and cp[2] == maxVal[1]):
-                    return True
+        if user.timeInterval is not None and user.existsAtInstant(t):
+            return self.positionInAnalysisZone(user.getCurvilinearPositionAtInstant(t))
+        else:
             return False
 
     def positionInAnalysisZone(self, curvilinearPosition):
         '''returns True if a curvilinear position is withing analysis zone bounds'''
-        for minVal, maxVal in zip(self.minAlignment, self.maxAlignment):
-            if (minVal[0] <= curvilinearPosition[0] and curvilinearPosition[2] == minVal[1]) or (curvilinearPosition[0] <= maxVal[0] and curvilinearPosition[2] == maxVal[1]):
-                return True
-        return False
+        s, lane = curvilinearPosition[0], curvilinearPosition[2]
+        return (lane in self.minCoordinates and self.minCoordinates[lane] <= s) or (lane in self.maxCoordinates and s <= self.maxCoordinates[lane])
+
+    def positionsInAnalysisZone(self, trajectory):
+        '''returns the boolean array of the positions of a curvilinear trajectory within analysis zone bounds'''
+        s = np.asarray(trajectory.positions[0], dtype=float)
+        lanes = np.asarray(trajectory.lanes)
+        inZone = np.zeros(len(s), dtype=bool)
+        for lane, minCoordinate in self.minCoordinates.items():
+            inZone |= (lanes == lane) & (minCoordinate <= s)
+        for lane, maxCoordinate in self.maxCoordinates.items():
+            inZone |= (lanes == lane) & (s <= maxCoordinate)
+        return inZone
 
     def getUserIntervalInAnalysisZone(self, user):
-        '''returns the time interval at which user passed through analysis zone'''
-        firstInstant = None
-        lastInstant = None
-        for t in list(user.timeInterval):
-            if self.userInAnalysisZoneAtInstant(user, t):
-                firstInstant = t
-                break
-        if firstInstant is None:
+        '''returns the time interval at which user passed through analysis zone
+        (first continuous passage, computed on the whole trajectory of the user)'''
+        if user.timeInterval is None or user.curvilinearPositions is None:
+            return None
+        inZone = self.positionsInAnalysisZone(user.curvilinearPositions)
+        indices = np.flatnonzero(inZone)
+        if len(indices) == 0:
             return None
+        first = indices[0]
+        outside = np.flatnonzero(~inZone[first:])
+        if len(outside) > 0:
+            last = first + outside[0] - 1
         else:
-            for instant in range(firstInstant, user.getLastInstant() + 1):
-                if not self.userInAnalysisZoneAtInstant(user, instant):
-                    lastInstant = instant - 1
-                    break
-            if lastInstant is None:
-                lastInstant = user.getLastInstant()
-            return moving.TimeInterval(firstInstant, lastInstant)
+            last = len(inZone) - 1
+        return moving.TimeInterval(user.getFirstInstant() + int(first), user.getFirstInstant() + int(last))
+
+    def updateUser(self, user, instant):
+        '''updates incrementally the time interval of the first passage of user through the zone
+        with its position at instant (stored in user.timeIntervalsInAnalysisZone, by zone area)'''
+        interval = user.timeIntervalsInAnalysisZone.get(self.area)
+        if interval is None or interval.last == instant - 1:
+            if self.positionInAnalysisZone(user.getCurvilinearPositionAt(-1)):
+                if interval is None:
+                    user.timeIntervalsInAnalysisZone[self.area] = moving.TimeInterval(instant, instant)
+                else:
+                    interval.last = instant
+
+    @staticmethod
+    def getUserInterval(user, area):
+        '''returns the time interval of the first passage of user through the zone of area
+        recorded during the simulation, None if it did not enter the zone'''
+        return user.timeIntervalsInAnalysisZone.get(area)
+
+
+class QuantileSketch(object):
+    '''bounded memory summary of a series of values to estimate their quantiles
+    the values are kept exactly until there are more than size,
+    then the sorted centroids (value, weight) are merged by adjacent pairs'''
+    def __init__(self, size=256):
+        self.size = size
+        self.values = []
+        self.weights = []
+        self.n = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        self.values.append(value)
+        self.weights.append(weight)
+        self.n += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.values) > self.size:
+            self.compress()
+
+    def compress(self):
+        '''merges the sorted centroids by adjacent pairs'''
+        order = np.argsort(self.values, kind='stable')
+        values = np.asarray(self.values)[order]
+        weights = np.asarray(self.weights, dtype=float)[order]
+        nPairs = len(values)//2
+        pairWeights = weights[:2*nPairs:2]+weights[1:2*nPairs:2]
+        self.values = list((values[:2*nPairs:2]*weights[:2*nPairs:2]+values[1:2*nPairs:2]*weights[1:2*nPairs:2])/pairWeights)
+        self.weights = list(pairWeights)
+        if len(values) > 2*nPairs:
+            self.values.append(values[-1])
+            self.weights.append(weights[-1])
+
+    def merge(self, other):
+        '''adds the centroids of another sketch (eg from another replication)'''
+        for value, weight in zip(other.values, other.weights):
+            self.add(value, weight)
+        if other.min is not None:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+    def getQuantile(self, q):
+        '''returns the quantile q (in [0, 1]) of the values, None if empty
+        (exact, with the linear interpolation of numpy.percentile, until the sketch is compressed)'''
+        if self.n == 0:
+            return None
+        order = np.argsort(self.values, kind='stable')
+        values = np.asarray(self.values)[order]
+        weights = np.asarray(self.weights, dtype=float)[order]
+        ranks = np.cumsum(weights)-(weights+1.)/2.  # rank of the middle of each centroid
+        return float(np.interp(q*(self.n-1), np.concatenate(([0.], ranks, [self.n-1])), np.concatenate(([self.min], values, [self.max]))))
+
+
+class IndicatorSummary(object):
+    '''aggregation of the most severe values of an indicator over interactions:
+    number, sum and minimum of the values, numbers of values smaller than or equal to the thresholds,
+    histogram (bins of width binWidth) and quantile sketch'''
+    def __init__(self, thresholds=[], binWidth=1., sketchSize=256):
+        self.thresholds = list(thresholds)
+        self.nBelowThresholds = [0]*len(self.thresholds)
+        self.binWidth = binWidth
+        self.histogram = {}  # bin index -> number of values
+        self.sketch = QuantileSketch(sketchSize)
+        self.n = 0
+        self.sum = 0.
+        self.min = None
+
+    def add(self, value):
+        self.n += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        for i, threshold in enumerate(self.thresholds):
+            if value <= threshold:
+                self.nBelowThresholds[i] += 1
+        binIdx = int(np.floor(value/self.binWidth))
+        self.histogram[binIdx] = self.histogram.get(binIdx, 0)+1
+        self.sketch.add(value)
+
+    def merge(self, other):
+        '''adds the values summarised in other (same thresholds and bin width)'''
+        self.n += other.n
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.nBelowThresholds = [n1+n2 for n1, n2 in zip(self.nBelowThresholds, other.nBelowThresholds)]
+        for binIdx, n in other.histogram.items():
+            self.histogram[binIdx] = self.histogram.get(binIdx, 0)+n
+        self.sketch.merge(other.sketch)
+
+    def getN(self):
+        return self.n
+
+    def getMin(self):
+        return self.min
+
+    def getMean(self):
+        if self.n > 0:
+            return self.sum/self.n
+        else:
+            return None
+
+    def getNBelow(self, threshold):
+        '''returns the number of values smaller than or equal to threshold (must be one of the thresholds)'''
+        return self.nBelowThresholds[self.thresholds.index(threshold)]
+
+    def getHistogram(self):
+        '''returns the list of (lower bound, number of values) of the non empty bins, by increasing value'''
+        return [(binIdx*self.binWidth, self.histogram[binIdx]) for binIdx in sorted(self.histogram)]
+
+    def getQuantile(self, q):
+        return self.sketch.getQuantile(q)
+
+
+class IndicatorAggregator(object):
+    '''online aggregation of the indicators of the interactions, fed by World.updateInteractions as the values are computed
+    - the most severe value of each indicator (minimum, or maximum if the indicator mostSevereIsMax) and its instant are kept for the current interactions
+    - when an interaction is completed, its most severe values are added to the summaries (IndicatorSummary) of its category
+    (same values as getMostSevereValue(1) on the complete indicators)
+    - if freeCompletedIndicators, the indicators of the completed interactions are then reduced to their most severe value'''
+    defaultIndicatorNames = [events.Interaction.indicatorNames[i] for i in [2, 5, 7, 10]]
+    defaultThresholds = {events.Interaction.indicatorNames[2]: [10, 20, 50]}
+
+    def __init__(self, indicatorNames=None, thresholds=None, binWidth=1., sketchSize=256, freeCompletedIndicators=False):
+        if indicatorNames is None:
+            indicatorNames = self.defaultIndicatorNames
+        if thresholds is None:
+            thresholds = self.defaultThresholds
+        self.indicatorNames = list(indicatorNames)
+        self.thresholds = thresholds
+        self.binWidth = binWidth
+        self.sketchSize = sketchSize
+        self.freeCompletedIndicators = freeCompletedIndicators
+        self.mostSevereValues = {}  # interaction key -> {indicator name: (value, instant)}
+        self.summaries = {}  # (category, indicator name) -> IndicatorSummary
+        self.nInteractions = {}  # category -> number of completed interactions
+
+    def addValue(self, inter, indicatorName, value, instant, mostSevereIsMax=False):
+        '''keeps value if it is more severe than the current value of the indicator of inter'''
+        if value is not None:
+            values = self.mostSevereValues.setdefault(inter.getKey(), {})
+            current = values.get(indicatorName)
+            if current is None or (mostSevereIsMax and value > current[0]) or (not mostSevereIsMax and value < current[0]):
+                values[indicatorName] = (value, instant)
+
+    def updateInteraction(self, inter, instant):
+        '''adds the values of the indicators of inter at instant'''
+        for indicatorName in self.indicatorNames:
+            indicator = inter.getIndicator(indicatorName)
+            if indicator is not None:
+                self.addValue(inter, indicatorName, indicator[instant], instant, indicator.mostSevereIsMax)
+
+    def getSummary(self, categoryNum, indicatorName, create=False):
+        summary = self.summaries.get((categoryNum, indicatorName))
+        if summary is None and create:
+            summary = IndicatorSummary(self.thresholds.get(indicatorName, []), self.binWidth, self.sketchSize)
+            self.summaries[(categoryNum, indicatorName)] = summary
+        return summary
+
+    def addSummaryValue(self, categoryNum, indicatorName, value):
+        '''adds directly the most severe value of an indicator of a completed interaction (eg PET)'''
+        self.getSummary(categoryNum, indicatorName, True).add(value)
+
+    def completeInteraction(self, inter):
+        '''adds the most severe values of inter to the summaries of its category and forgets inter'''
+        self.nInteractions[inter.categoryNum] = self.nInteractions.get(inter.categoryNum, 0)+1
+        for indicatorName, (value, instant) in self.mostSevereValues.pop(inter.getKey(), {}).items():
+            self.addSummaryValue(inter.categoryNum, indicatorName, value)
+            if self.freeCompletedIndicators:
+                indicator = inter.getIndicator(indicatorName)
+                inter.addIndicator(indicators.SeverityIndicator(indicator.name, {instant: value}, mostSevereIsMax=indicator.mostSevereIsMax))
+
+    def getNInteractions(self, categoryNum):
+        return self.nInteractions.get(categoryNum, 0)
+
+    def getNBelow(self, categoryNum, indicatorName, threshold):
+        '''returns the number of completed interactions of the category
+        whose most severe indicator value is smaller than or equal to threshold'''
+        summary = self.getSummary(categoryNum, indicatorName)
+        if summary is None:
+            return 0
+        else:
+            return summary.getNBelow(threshold)
+
+    def merge(self, other):
+        '''adds the summaries of other (eg from another replication)'''
+        for categoryNum, n in other.nInteractions.items():
+            self.nInteractions[categoryNum] = self.nInteractions.get(categoryNum, 0)+n
+        for (categoryNum, indicatorName), summary in other.summaries.items():
+            self.getSummary(categoryNum, indicatorName, True).merge(summary)
 
 
 def createAnalysisTable(fileName):
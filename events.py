@@ -2,9 +2,14 @@
 '''Libraries for events
 Interactions, pedestrian crossing...'''
 
-from trafficintelligence import moving, prediction, indicators, utils, cvutils, ml
+from collections.abc import MutableMapping
+
+import numpy as np
+from trafficintelligence import moving, prediction, utils, cvutils, ml
 from trafficintelligence.base import VideoFilenameAddable
 
+import indicators
+
 
 def findRoute(prototypes, objects, i, j, noiseEntryNums, noiseExitNums, minSimilarity=0.3, spatialThreshold=1.0,
               delta=180):
@@ -115,6 +120,11 @@ class Interaction(moving.STObject, VideoFilenameAddable):
     def getRoadUserNumbers(self):
         return self.roadUserNumbers
 
+    def getKey(self):
+        '''Returns the key of the interaction in interaction registries (see getInteractionKey)'''
+        nums = sorted(self.roadUserNumbers)
+        return getInteractionKey(nums[0], nums[-1])
+
     def setRoadUsers(self, objects):
         nums = sorted(list(self.getRoadUserNumbers()))
         if nums[0] < len(objects) and objects[nums[0]].getNum() == nums[0]:
@@ -149,11 +159,10 @@ class Interaction(moving.STObject, VideoFilenameAddable):
             return None
 
     def getSubInteraction(self, timeInterval):
-        from trafficintelligence import indicators
+        '''returns the interaction restricted to timeInterval,
+        its indicators are views of the indicators of self in timeInterval, created on demand (see SubIndicators)'''
         subInteraction = Interaction(num=self.num, roadUser1=self.roadUser1, roadUser2=self.roadUser2, categoryNum=self.categoryNum, useCurvilinear=self.useCurvilinear, timeInterval=timeInterval)
-        for indicator in self.indicators:
-            subIndicator = indicators.SeverityIndicator(self.indicators[indicator].name, self.getIndicatorValuesInTimeInterval(timeInterval, self.indicators[indicator].name), mostSevereIsMax=False)
-            subInteraction.addIndicator(subIndicator)
+        subInteraction.indicators = SubIndicators(self.indicators, timeInterval)
         return subInteraction
 
     def getIndicatorValuesAtInstant(self, instant):
@@ -225,7 +234,7 @@ class Interaction(moving.STObject, VideoFilenameAddable):
                     self.getIndicator('Distance').values[instant] = distance
 
     def computeTTCAtInstant(self, world, timeStep, instant, maxValue, buffer=0, analysisZone=None):
-        crossingPoints = world.getNodesFromCrossingPoints(self.roadUser1, self.roadUser2, instant)[0]
+        crossingPoints = world.getNodesFromCrossingPoints(self.roadUser1, self.roadUser2, instant)
         if crossingPoints is not None:
 
             v1 = self.roadUser1.getCurvilinearVelocityAtInstant(instant)[0] / timeStep
@@ -501,6 +510,169 @@ class Interaction(moving.STObject, VideoFilenameAddable):
         return self.crossingZones
 
 
+class SubIndicators(MutableMapping):
+    '''Indicators of a sub-interaction (see Interaction.getSubInteraction):
+    the indicators of the parent interaction are not copied,
+    each access returns a view of the parent indicator in the time interval (see indicators.TemporalIndicator.getSubIndicator)
+    the indicators added to the sub-interaction are stored separately'''
+    def __init__(self, parentIndicators, timeInterval):
+        self.parentIndicators = parentIndicators
+        self.timeInterval = timeInterval
+        self.addedIndicators = {}
+
+    def __getitem__(self, indicatorName):
+        if indicatorName in self.addedIndicators:
+            return self.addedIndicators[indicatorName]
+        else:
+            return self.parentIndicators[indicatorName].getSubIndicator(self.timeInterval)
+
+    def __setitem__(self, indicatorName, indicator):
+        self.addedIndicators[indicatorName] = indicator
+
+    def __delitem__(self, indicatorName):
+        del self.addedIndicators[indicatorName]
+
+    def __iter__(self):
+        for indicatorName in self.parentIndicators:
+            if indicatorName not in self.addedIndicators:
+                yield indicatorName
+        for indicatorName in self.addedIndicators:
+            yield indicatorName
+
+    def __len__(self):
+        return len(set(self.parentIndicators) | set(self.addedIndicators))
+
+
+class InteractionSummary(object):
+    '''Lightweight summary of a completed interaction, kept in memory in bounded memory mode
+    once the interaction is flushed to the sink (see World.flushCompleted):
+    most severe value of each indicator (indicators added later, eg PET, are summarised the same way)'''
+    def __init__(self, interaction):
+        self.num = interaction.getNum()
+        self.roadUserNumbers = interaction.getRoadUserNumbers()
+        self.categoryNum = interaction.categoryNum
+        self.timeInterval = moving.TimeInterval(interaction.getFirstInstant(), interaction.getLastInstant())
+        self.mostSevereValues = {}
+        for indicator in interaction.indicators.values():
+            self.addIndicator(indicator)
+
+    def getNum(self):
+        return self.num
+
+    def getRoadUserNumbers(self):
+        return self.roadUserNumbers
+
+    def getKey(self):
+        nums = sorted(self.roadUserNumbers)
+        return getInteractionKey(nums[0], nums[-1])
+
+    def addIndicator(self, indicator):
+        if indicator is not None:
+            self.mostSevereValues[indicator.name] = indicator.getMostSevereValue(1)
+
+    def getMostSevereValue(self, indicatorName):
+        return self.mostSevereValues.get(indicatorName)
+
+
+class InteractionIndicatorEngine(object):
+    '''Batched computation of the indicators of the current interactions of a world at each step
+    (see World.updateInteractions)
+
+    the states of the users of the interactions (coordinates, curvilinear position, current alignment,
+    last speed, length) are gathered in numpy arrays, the distance, rear end TTC and speed differential
+    and side TTC are computed for all interactions at once with the same formulas as World.updateInteractions,
+    and the values are then set in the indicators of the interactions, so that the results are identical'''
+    def __init__(self, world):
+        self.world = world
+        self.alignmentLengths = np.array([al.getTotalDistance() for al in world.alignments])
+        self.transversalAlignments = np.zeros((len(world.alignments), len(world.alignments)), dtype=bool)
+        for al in world.alignments:
+            if al.transversalAlignments is not None:
+                for al2 in al.transversalAlignments:
+                    self.transversalAlignments[al.getIdx(), al2.getIdx()] = True
+
+    def getUserStates(self, users, instant):
+        '''returns the arrays of the states of users at instant'''
+        x = np.empty(len(users))
+        y = np.empty(len(users))
+        s = np.empty(len(users))
+        alignmentIndices = np.empty(len(users), dtype=int)
+        speeds = np.full(len(users), np.nan)  # nan if the user has no velocity yet
+        lengths = np.empty(len(users))
+        for i, u in enumerate(users):
+            x[i], y[i] = self.world.getXYAtInstant(u, instant)
+            s[i] = u.getCurvilinearPositionAtInstant(instant)[0]
+            alignmentIndices[i] = u.getCurrentAlignment().getIdx()
+            if len(u.getCurvilinearVelocities()) > 0:
+                speeds[i] = u.getCurvilinearVelocityAt(-1)[0]
+            lengths[i] = u.geometry
+        return x, y, s, alignmentIndices, speeds, lengths
+
+    @staticmethod
+    def setIndicatorValue(inter, indicatorName, instant, value):
+        indicator = inter.getIndicator(indicatorName)
+        if indicator is None:
+            inter.addIndicator(indicators.SeverityIndicator(indicatorName, {instant: value}, mostSevereIsMax=False))
+        else:
+            indicator.setValue(instant, value)
+
+    def updateIndicators(self, interactions, instant):
+        '''computes the indicators of interactions at instant'''
+        if len(interactions) == 0:
+            return
+        rows = {}
+        users = []
+        rows1 = np.empty(len(interactions), dtype=int)
+        rows2 = np.empty(len(interactions), dtype=int)
+        categories = np.zeros(len(interactions), dtype=int)
+        for i, inter in enumerate(interactions):
+            for u, userRows in ((inter.roadUser1, rows1), (inter.roadUser2, rows2)):
+                num = u.getNum()
+                if num not in rows:
+                    rows[num] = len(users)
+                    users.append(u)
+                userRows[i] = rows[num]
+            if inter.categoryNum in (1, 2):
+                categories[i] = inter.categoryNum
+        x, y, s, alignmentIndices, speeds, lengths = self.getUserStates(users, instant)
+
+        # the squares are computed as in World.distanceAtInstant (python float power) so that the distances are identical
+        distances = np.sqrt([dx**2 + dy**2 for dx, dy in zip((x[rows1]-x[rows2]).tolist(), (y[rows1]-y[rows2]).tolist())])
+        v1 = speeds[rows1]
+        v2 = speeds[rows2]
+        ttcs = np.full(len(interactions), np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # rear end: roadUser2 is the leader
+            rearEnd = categories == 1
+            distances[rearEnd] -= lengths[rows2[rearEnd]]
+            rearEndTTC = rearEnd & (v2 < v1)
+            ttcs[rearEndTTC] = distances[rearEndTTC] / (v1[rearEndTTC] - v2[rearEndTTC])
+            speedDifferential = rearEndTTC & ((v1 != 0) | (v2 != 0))
+
+            # side: time to the end of the alignments
+            side = (categories == 2) & self.transversalAlignments[alignmentIndices[rows1], alignmentIndices[rows2]] & (v1 > 0) & (v2 > 0)
+            t1 = (self.alignmentLengths[alignmentIndices[rows1]] - s[rows1]) / v1
+            t2 = (self.alignmentLengths[alignmentIndices[rows2]] - s[rows2]) / v2
+            firstIs1 = t1 < t2
+            tFirst = np.where(firstIs1, t1, t2)
+            tSecond = np.where(firstIs1, t2, t1)
+            firstClearingTime = np.where(firstIs1, lengths[rows1] / v1, lengths[rows2] / v2)
+            sideTTC = side & (tSecond < tFirst + firstClearingTime)
+            ttcs[sideTTC] = tSecond[sideTTC]
+
+        hasTTC = (rearEndTTC | sideTTC).tolist()
+        speedDifferential = speedDifferential.tolist()
+        distances = distances.tolist()
+        ttcs = ttcs.tolist()
+        speedDifferentials = (v1 - v2).tolist()
+        for i, inter in enumerate(interactions):
+            self.setIndicatorValue(inter, Interaction.indicatorNames[2], instant, distances[i])
+            if hasTTC[i]:
+                self.setIndicatorValue(inter, Interaction.indicatorNames[7], instant, ttcs[i])
+            if speedDifferential[i]:
+                self.setIndicatorValue(inter, Interaction.indicatorNames[5], instant, speedDifferentials[i])
+
+
 def createInteractions(objects, _others=None):
     '''Create all interactions of two co-existing road users'''
     if _others is not None:
@@ -521,8 +693,17 @@ def createInteractions(objects, _others=None):
 
 
 
+def getInteractionKey(roadUserNum1, roadUserNum2):
+    '''Returns the key of the interaction between two road users:
+    the ordered pair of their numbers'''
+    return (min(roadUserNum1, roadUserNum2), max(roadUserNum1, roadUserNum2))
+
+
 def findInteraction(interactions, roadUserNum1, roadUserNum2):
-    'Returns the right interaction in the set'
+    '''Returns the right interaction in the set
+    interactions is either a list or a dict indexed by interaction keys (see getInteractionKey)'''
+    if isinstance(interactions, dict):
+        return interactions.get(getInteractionKey(roadUserNum1, roadUserNum2))
     i = 0
     while i < len(interactions) and set([roadUserNum1, roadUserNum2]) != interactions[i].getRoadUserNumbers():
         i += 1
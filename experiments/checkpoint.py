@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+'''checks that a simulation checkpointed at an instant, restored (from a file and from memory) and resumed
+gives the same users, trajectories, interactions and indicators as the uninterrupted simulation
+usage: checkpoint.py [world file [checkpoint instant]]'''
+import sys
+
+import network
+import simulation
+
+worldFilename = sys.argv[1] if len(sys.argv) > 1 else 'config files/stop.yml'
+checkpointFilename = 'checkpoint-check.pkl'
+sim = simulation.Simulation.load('config files/stop-config.yml')
+sim.duration = 60
+checkpointInstant = int(sys.argv[2]) if len(sys.argv) > 2 else int(sim.duration/sim.timeStep/2)
+
+
+def getResults(world):
+    '''returns the users (with their trajectories) and the interactions (with their indicators) of world'''
+    users = {}
+    for u in world.completed + world.users:
+        if u.timeInterval is not None:
+            users[u.getNum()] = (u.getFirstInstant(), u.getLastInstant(),
+                                 [tuple(p) for p in u.curvilinearPositions], [tuple(v) for v in u.curvilinearVelocities],
+                                 list(u.freeFlow), u.getIntersectionEntryInstant(), u.getIntersectionExitInstant())
+    interactions = {}
+    for inter in world.completedInteractions + list(world.interactions.values()):
+        interactions[inter.getKey()] = (inter.num, inter.categoryNum, inter.getFirstInstant(), inter.getLastInstant(),
+                                        {name: dict(indicator.values) for name, indicator in inter.indicators.items()})
+    return users, interactions
+
+
+def compare(name, reference, results):
+    '''prints the differences between the results and the reference, returns True if they are identical'''
+    referenceUsers, referenceInteractions = reference
+    users, interactions = results
+    differentUsers = [num for num in set(referenceUsers) | set(users) if referenceUsers.get(num) != users.get(num)]
+    differentInteractions = [key for key in set(referenceInteractions) | set(interactions) if referenceInteractions.get(key) != interactions.get(key)]
+    print('{}: {} users ({} different), {} interactions ({} different)'.format(name, len(users), len(differentUsers), len(interactions), len(differentInteractions)))
+    return len(differentUsers) == 0 and len(differentInteractions) == 0
+
+
+world = network.World.load(worldFilename)
+sim.run(world)
+reference = getResults(world)
+
+world = network.World.load(worldFilename)
+sim.start(world)
+sim.resume(world, checkpointInstant)
+sim.saveCheckpoint(world, checkpointFilename)
+checkpoint = sim.getCheckpoint(world)
+sim.resume(world)
+identical = compare('continued after checkpoint', reference, getResults(world))
+
+restoredSim, restoredWorld = simulation.Simulation.loadCheckpoint(checkpointFilename)
+restoredSim.resume(restoredWorld)
+identical = compare('restored from {}'.format(checkpointFilename), reference, getResults(restoredWorld)) and identical
+
+restoredSim, restoredWorld = simulation.Simulation.restoreCheckpoint(checkpoint)
+restoredSim.resume(restoredWorld)
+identical = compare('restored from memory', reference, getResults(restoredWorld)) and identical
+
+if identical:
+    print('the restored simulations are identical to the uninterrupted simulation')
+else:
+    print('the restored simulations differ from the uninterrupted simulation')
+    sys.exit(1)
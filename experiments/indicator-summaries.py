@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+'''checks that the summaries of the indicators computed in one vectorised pass (analysis.getIndicatorSummaries)
+are the same as the values computed indicator by indicator (SeverityIndicator.getMostSevereValue...)
+for the interactions of a simulation, and for the same values if the most severe value is the maximum
+usage: indicator-summaries.py [world file]'''
+import sys
+
+import numpy as np
+
+import analysis
+import events
+import indicators
+import network
+import simulation
+
+worldFilename = sys.argv[1] if len(sys.argv) > 1 else 'config files/stop.yml'
+sim = simulation.Simulation.load('config files/stop-config.yml')
+sim.duration = 60
+centiles = [15, 50, 85]
+thresholds = {events.Interaction.indicatorNames[2]: 20, events.Interaction.indicatorNames[5]: 1, events.Interaction.indicatorNames[7]: 50, events.Interaction.indicatorNames[10]: 10}
+
+
+def getSummaries(indicator, minNInstants, threshold):
+    '''returns the summaries of indicator computed with its methods (NaN if there is no value)'''
+    if indicator is None or indicator.nValues == 0:
+        return np.nan, np.nan, [np.nan]*len(centiles), 0
+    mostSevereValue = indicator.getMostSevereValue(minNInstants)
+    return (np.nan if mostSevereValue is None else mostSevereValue, indicator.getInstantOfMostSevereValue(),
+            [indicator.getMostSevereValue(centile=centile) for centile in centiles],
+            sum(value <= threshold for value in indicator.getValues(False)))
+
+
+def compare(name, indicatorList, summaries, minNInstants, threshold):
+    '''prints the number of indicators whose summaries differ from the values computed indicator by indicator,
+    returns True if there is none'''
+    mostSevereValues, mostSevereInstants, centileValues, nBelowThreshold = summaries
+    nDifferent = 0
+    for k, indicator in enumerate(indicatorList):
+        mostSevereValue, mostSevereInstant, indicatorCentiles, nBelow = getSummaries(indicator, minNInstants, threshold)
+        if not (np.allclose(mostSevereValues[k], mostSevereValue, equal_nan=True)
+                and np.allclose(mostSevereInstants[k], mostSevereInstant, equal_nan=True)
+                and np.allclose(centileValues[k], indicatorCentiles, equal_nan=True)
+                and nBelowThreshold[k] == nBelow):
+            nDifferent += 1
+    print('{} (minNInstants {}): {} indicators ({} different)'.format(name, minNInstants, sum(indicator is not None for indicator in indicatorList), nDifferent))
+    return nDifferent == 0
+
+
+world = network.World.load(worldFilename)
+sim.run(world)
+interactions = world.completedInteractions + list(world.interactions.values())
+
+identical = True
+for indicatorName, threshold in thresholds.items():
+    indicatorList = [inter.getIndicator(indicatorName) for inter in interactions]
+    # same values with the maximum as the most severe value
+    maxIndicatorList = [None if indicator is None else indicators.SeverityIndicator(indicator.name, dict(indicator.values), mostSevereIsMax=True) for indicator in indicatorList]
+    for minNInstants in [1, 3]:
+        identical = compare(indicatorName, indicatorList, analysis.getIndicatorSummaries(interactions, indicatorName, minNInstants, centiles, threshold), minNInstants, threshold) and identical
+        identical = compare(indicatorName + ' (maximum)', maxIndicatorList, indicators.getSeveritySummaries(maxIndicatorList, True, minNInstants, centiles, threshold), minNInstants, threshold) and identical
+
+if identical:
+    print('the vectorised summaries are identical to the summaries computed indicator by indicator')
+else:
+    print('the vectorised summaries differ from the summaries computed indicator by indicator')
+    sys.exit(1)
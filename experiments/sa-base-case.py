@@ -11,7 +11,7 @@ sim.computeInteractions = True
 sim.dbName = 'sensivity-analysis-data.db'
 sim.verbose = False
 
-seeds = [sim.seed+i*sim.increment for i in range(sim.rep)]
+seeds = sim.getSeeds()
 
 rearEndnInter10 = []
 rearEndnInter20 = []
@@ -24,25 +24,24 @@ minTTCs = {1: [], 2: []}
 minDistances = {1: [], 2: []}
 
 PETs = []
-interactions = []
+interactions = []  # (seed, interaction num)
 numberOfcompletedUsers0 = []
 numberOfcompletedUsers2 = []
 
-for seed in seeds:
-    print('run {} out of {}'.format(seeds.index(seed) + 1, len(seeds)))
-    sim.seed = seed
-    world = network.World.load('config files/stop.yml')
-    result = sim.run(world)
-    numberOfcompletedUsers0.append(len([user for user in world.completed if user.getInitialAlignment().idx == 0]))
-    numberOfcompletedUsers2.append(len([user for user in world.completed if user.getInitialAlignment().idx == 2]))
 
+def processResult(world, sim):
+    '''returns the numbers of completed users from alignments 0 and 2 and the indicators of the interactions
+    of a replication: minimum distances and TTCs by category, PETs and numbers of the interactions with more than 5 TTC values'''
+    completedUsers0 = len([user for user in world.completed if user.getInitialAlignment().idx == 0])
+    completedUsers2 = len([user for user in world.completed if user.getInitialAlignment().idx == 2])
     tempMinDistances = {1: [], 2: []}
-
+    tempMinTTCs = {1: [], 2: []}
+    tempPETs = []
+    interactionNums = []
     for inter in world.completedInteractions:
         if inter.categoryNum is not None:
             distance = inter.getIndicator(events.Interaction.indicatorNames[2])
             if distance is not None:
-                minDistances[inter.categoryNum].append(distance.getMostSevereValue(1))
                 tempMinDistances[inter.categoryNum].append(distance.getMostSevereValue(1))
             ttc = inter.getIndicator(events.Interaction.indicatorNames[7])
             if ttc is not None:
@@ -50,12 +49,25 @@ for seed in seeds:
                 if minTTC < 0:
                     print(inter.num, inter.categoryNum, ttc.values)
                 if minTTC < 20:
-                    minTTCs[inter.categoryNum].append(minTTC)
+                    tempMinTTCs[inter.categoryNum].append(minTTC)
                 values = ttc.getValues(False)
                 if len(values) > 5:
-                    interactions.append(inter)
+                    interactionNums.append(inter.num)
             if inter.getIndicator(events.Interaction.indicatorNames[10]) is not None:
-                PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1)*sim.timeStep)
+                tempPETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1)*sim.timeStep)
+    return completedUsers0, completedUsers2, tempMinDistances, tempMinTTCs, tempPETs, interactionNums
+
+
+replicationResults = sim.runReplications('config files/stop.yml', processResult=processResult)
+for seed, (completedUsers0, completedUsers2, tempMinDistances, tempMinTTCs, tempPETs, interactionNums) in zip(seeds, replicationResults):
+    print('run {} out of {}'.format(seeds.index(seed) + 1, len(seeds)))
+    numberOfcompletedUsers0.append(completedUsers0)
+    numberOfcompletedUsers2.append(completedUsers2)
+    for categoryNum in tempMinDistances:
+        minDistances[categoryNum].extend(tempMinDistances[categoryNum])
+        minTTCs[categoryNum].extend(tempMinTTCs[categoryNum])
+    PETs.extend(tempPETs)
+    interactions.extend((seed, num) for num in interactionNums)
 
     rearEndnInter10.append((np.array(tempMinDistances[1]) <= 10).sum())
     rearEndnInter20.append((np.array(tempMinDistances[1]) <= 20).sum())
@@ -8,8 +8,9 @@ import toolkit
 
 sQuo_world = network.World.load('config files/sQuo.yml')
 sQuo_sim = simulation.Simulation.load('config files/sQuo-config.yml')
+sQuo_sim.aggregateIndicators = True  # numbers of interactions below the distance thresholds counted online
 
-seeds = [sQuo_sim.seed+i*sQuo_sim.increment for i in range(sQuo_sim.rep)]
+seeds = sQuo_sim.getSeeds()
 sQuo_minTTCs = {1: [], 2: []}
 sQuo_minDistances = {1: {}, 2: {}}
 for categoryNum in sQuo_minDistances:
@@ -17,7 +18,7 @@ for categoryNum in sQuo_minDistances:
         sQuo_minDistances[categoryNum][seed] = []#
 
 sQuo_PETs = []
-sQuo_interactions = []
+sQuo_interactions = []  # (seed, interaction num)
 
 sQuo_rearEndnInter10 = []
 sQuo_rearEndnInter20 = []
@@ -28,36 +29,51 @@ sQuo_sidenInter20 = []
 sQuo_sidenInter50 = []
 
 
-for seed in seeds:
-    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
-    sQuo_world = network.World.load('config files/sQuo.yml')
-    sQuo_sim.seed = seed
-    sQuo_sim.run(sQuo_world)
-    for inter in sQuo_world.completedInteractions:
+def processResult(world, sim):
+    '''returns the indicators of the interactions of a replication: minimum distances and TTCs by category,
+    PETs, numbers of the interactions with more than 5 TTC values
+    and numbers of interactions by category with a minimum distance below 10, 20 and 50 (from the indicator aggregator)'''
+    minDistances = {1: [], 2: []}
+    minTTCs = {1: [], 2: []}
+    PETs = []
+    interactionNums = []
+    for inter in world.completedInteractions:
         if inter.categoryNum is not None:
             sQuo_distance = inter.getIndicator(events.Interaction.indicatorNames[2])
             if sQuo_distance is not None:
-                sQuo_minDistances[inter.categoryNum][seed].append(sQuo_distance.getMostSevereValue(1))
+                minDistances[inter.categoryNum].append(sQuo_distance.getMostSevereValue(1))
             sQuo_ttc = inter.getIndicator(events.Interaction.indicatorNames[7])
             if sQuo_ttc is not None:
-                sQuo_minTTC = sQuo_ttc.getMostSevereValue(1)*sQuo_sim.timeStep  # seconds
+                sQuo_minTTC = sQuo_ttc.getMostSevereValue(1)*sim.timeStep  # seconds
                 if sQuo_minTTC < 0:
                     print(inter.num, inter.categoryNum, sQuo_ttc.values)
                 if sQuo_minTTC < 20:
-                    sQuo_minTTCs[inter.categoryNum].append(sQuo_minTTC)
+                    minTTCs[inter.categoryNum].append(sQuo_minTTC)
                 values = sQuo_ttc.getValues(False)
                 if len(values) > 5:
-                    sQuo_interactions.append(inter)
+                    interactionNums.append(inter.num)
             if inter.getIndicator(events.Interaction.indicatorNames[10]) is not None:
-                sQuo_PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+                PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+    nInter = {categoryNum: [world.indicatorAggregator.getNBelow(categoryNum, events.Interaction.indicatorNames[2], threshold) for threshold in [10, 20, 50]] for categoryNum in [1, 2]}
+    return minDistances, minTTCs, PETs, interactionNums, nInter
+
+
+sQuo_replicationResults = sQuo_sim.runReplications('config files/sQuo.yml', processResult=processResult)
+for seed, (minDistances, minTTCs, PETs, interactionNums, nInter) in zip(seeds, sQuo_replicationResults):
+    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
+    for categoryNum in minDistances:
+        sQuo_minDistances[categoryNum][seed].extend(minDistances[categoryNum])
+        sQuo_minTTCs[categoryNum].extend(minTTCs[categoryNum])
+    sQuo_PETs.extend(PETs)
+    sQuo_interactions.extend((seed, num) for num in interactionNums)
 
-    sQuo_rearEndnInter10.append((np.array(sQuo_minDistances[1][seed]) <= 10).sum())
-    sQuo_rearEndnInter20.append((np.array(sQuo_minDistances[1][seed]) <= 20).sum())
-    sQuo_rearEndnInter50.append((np.array(sQuo_minDistances[1][seed]) <= 50).sum())
+    sQuo_rearEndnInter10.append(nInter[1][0])
+    sQuo_rearEndnInter20.append(nInter[1][1])
+    sQuo_rearEndnInter50.append(nInter[1][2])
 
-    sQuo_sidenInter10.append((np.array(sQuo_minDistances[2][seed]) <= 10).sum())
-    sQuo_sidenInter20.append((np.array(sQuo_minDistances[2][seed]) <= 20).sum())
-    sQuo_sidenInter50.append((np.array(sQuo_minDistances[2][seed]) <= 50).sum())
+    sQuo_sidenInter10.append(nInter[2][0])
+    sQuo_sidenInter20.append(nInter[2][1])
+    sQuo_sidenInter50.append(nInter[2][2])
 
 sQuo_nInter10 = {1: np.mean(sQuo_rearEndnInter10), 2: np.mean(sQuo_sidenInter10)}
 sQuo_nInter20 = {1: np.mean(sQuo_rearEndnInter20), 2: np.mean(sQuo_sidenInter20)}
@@ -26,22 +26,15 @@ sidenInter50 = {}
 durations = {}
 PETs = {}
 
-sim = simulation.Simulation.load('config files/config.yml')
-seeds = [sim.seed+i*sim.increment for i in range(sim.rep)]
-
-for seed in seeds:
-    readEndTTCs[seed] = []
-    PETs[seed] = []
-    sideTTCs[seed] = []
-    readEndMinDistance[seed] = []
-    sideMinDistance[seed] = []
-
-    print('{}'.format(seeds.index(seed)+1) + '/' + str(len(seeds)))
-
-    sim.seed = seed
-    world = network.World.load('config files/stop.yml')
-    sim.run(world)
 
+def processResult(world, sim):
+    '''returns the minimum TTCs and distances of the rear end and side interactions
+    and the PETs of the side interactions of a replication'''
+    readEndTTCs = []
+    readEndMinDistance = []
+    sideTTCs = []
+    sideMinDistance = []
+    PETs = []
     for inter in world.completedInteractions:
         if inter.categoryNum == 1:
 
@@ -49,38 +42,39 @@ for seed in seeds:
             if rearEndTTCIndicator is not None:
                 ttc = rearEndTTCIndicator.getMostSevereValue(1) * sim.timeStep
                 if ttc < 20:  # getIndicator('Time to Collision') is not None:
-                    readEndTTCs[seed].append(ttc)  # (withNone=False)))
+                    readEndTTCs.append(ttc)  # (withNone=False)))
 
             readEndMinDistanceIndicator = inter.getIndicator(events.Interaction.indicatorNames[2])
             if readEndMinDistanceIndicator is not None:
-                readEndMinDistance[seed].append(readEndMinDistanceIndicator.getMostSevereValue(1))
-
-
-            # rearEndnInter10[seed] = [(np.array(readEndMinDistance[seed]) <= 10).sum()]
-            # rearEndnInter20[seed] = [(np.array(readEndMinDistance[seed]) <= 20).sum()]
-            # rearEndnInter50[seed] = [(np.array(readEndMinDistance[seed]) <= 50).sum()]
+                readEndMinDistance.append(readEndMinDistanceIndicator.getMostSevereValue(1))
 
         elif inter.categoryNum == 2:
 
             sideTTCIndicator = inter.getIndicator(events.Interaction.indicatorNames[7])
             if sideTTCIndicator is not None:
                 ttc = sideTTCIndicator.getMostSevereValue(1) * sim.timeStep
-                if ttc < 20:  # getIndicator('Time to Collision') is not None:	
-                    sideTTCs[seed].append(ttc)  # (withNone=False)))     
+                if ttc < 20:  # getIndicator('Time to Collision') is not None:
+                    sideTTCs.append(ttc)  # (withNone=False)))
 
             sideMinDistanceIndicator = inter.getIndicator(events.Interaction.indicatorNames[2])
             if sideMinDistanceIndicator is not None:
-                sideMinDistance[seed].append(sideMinDistanceIndicator.getMostSevereValue(1))
-
-            # sidenInter10[seed] = [(np.array(sideMinDistance[seed]) <= 10).sum()]
-            # sidenInter20[seed] = [(np.array(sideMinDistance[seed]) <= 20).sum()]
-            # sidenInter50[seed] = [(np.array(sideMinDistance[seed]) <= 50).sum()]
+                sideMinDistance.append(sideMinDistanceIndicator.getMostSevereValue(1))
 
             petIndicator = inter.getIndicator(events.Interaction.indicatorNames[10])
             if petIndicator is not None:
                 pet = petIndicator.getMostSevereValue(1) * sim.timeStep
                 if pet < 20:
-                    PETs[seed].append(pet)
+                    PETs.append(pet)
+    return readEndTTCs, readEndMinDistance, sideTTCs, sideMinDistance, PETs
+
+
+sim = simulation.Simulation.load('config files/config.yml')
+seeds = sim.getSeeds()
+
+replicationResults = sim.runReplications('config files/stop.yml', processResult=processResult)
+for seed, result in zip(seeds, replicationResults):
+    readEndTTCs[seed], readEndMinDistance[seed], sideTTCs[seed], sideMinDistance[seed], PETs[seed] = result
+    print('{}'.format(seeds.index(seed)+1) + '/' + str(len(seeds)))
 
     rearEndnInter10[seed] = [(np.array(readEndMinDistance[seed]) <= 10).sum()]
     rearEndnInter20[seed] = [(np.array(readEndMinDistance[seed]) <= 20).sum()]
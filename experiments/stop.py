@@ -13,7 +13,7 @@ stop_sim.dbName = 'stop-data.db'
 # stop_analysis.interactions = []
 #an.createAnalysisTable(sim.dbName)
 
-seeds = [stop_sim.seed+i*stop_sim.increment for i in range(stop_sim.rep)]
+seeds = stop_sim.getSeeds()
 stop_minTTCs = {1: [], 2: []}
 stop_minDistances = {1: {}, 2: {}}
 for categoryNum in stop_minDistances:
@@ -21,7 +21,7 @@ for categoryNum in stop_minDistances:
         stop_minDistances[categoryNum][seed] = []#
 
 stop_PETs = []
-stop_interactions = []
+stop_interactions = []  # (seed, interaction num)
 
 stop_rearEndnInter10 = []
 stop_rearEndnInter20 = []
@@ -32,46 +32,56 @@ stop_sidenInter20 = []
 stop_sidenInter50 = []
 
 
-#analysis.saveParametersToTable(sim.dbName)
-for seed in seeds:
-    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
-    stop_world = network.World.load('config files/stop.yml')
-    stop_sim.seed = seed
-    stop_sim.run(stop_world)
-    # stop_analysis.seed = seed
-    # stop_analysis.interactions.append(stop_world.completedInteractions)
-    #stop.saveIndicators(sim.dbName)
-    for inter in stop_world.completedInteractions:
+def processResult(world, sim):
+    '''returns the indicators of the interactions of a replication: minimum distances and TTCs by category,
+    PETs and numbers of the interactions with more than 5 TTC values'''
+    minDistances = {1: [], 2: []}
+    minTTCs = {1: [], 2: []}
+    PETs = []
+    interactionNums = []
+    for inter in world.completedInteractions:
         if inter.categoryNum is not None:
             stop_distance = inter.getIndicator(events.Interaction.indicatorNames[2])
             if stop_distance is not None:
 
                 if inter.categoryNum == 1:
                     if inter.roadUser1.getInitialAlignment().idx == 2:
-                        stop_distance[inter.categoryNum][seed].append(stop_distance.getMostSevereValue(1))
+                        minDistances[inter.categoryNum].append(stop_distance.getMostSevereValue(1))
                 else:
-                    stop_distance[inter.categoryNum][seed].append(stop_distance.getMostSevereValue(1))
+                    minDistances[inter.categoryNum].append(stop_distance.getMostSevereValue(1))
 
-                # stop_minDistances[inter.categoryNum][seed].append(stop_distance.getMostSevereValue(1))
             stop_ttc = inter.getIndicator(events.Interaction.indicatorNames[7])
             if stop_ttc is not None:
-                stop_minTTC = stop_ttc.getMostSevereValue(1)*stop_sim.timeStep  # seconds
+                stop_minTTC = stop_ttc.getMostSevereValue(1)*sim.timeStep  # seconds
                 if stop_minTTC < 0:
                     print(inter.num, inter.categoryNum, stop_ttc.values)
                 if stop_minTTC < 20:
 
                     if inter.categoryNum == 1:
                         if inter.roadUser1.getInitialAlignment().idx == 2:
-                            stop_minTTCs[inter.categoryNum].append(stop_minTTC)
+                            minTTCs[inter.categoryNum].append(stop_minTTC)
                     else:
-                        stop_minTTCs[inter.categoryNum].append(stop_minTTC)
-                    # stop_minTTCs[inter.categoryNum].append(stop_minTTC)
+                        minTTCs[inter.categoryNum].append(stop_minTTC)
 
                 values = stop_ttc.getValues(False)
                 if len(values) > 5:
-                    stop_interactions.append(inter)
+                    interactionNums.append(inter.num)
             if inter.getIndicator(events.Interaction.indicatorNames[10]) is not None:
-                stop_PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+                PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+    return minDistances, minTTCs, PETs, interactionNums
+
+
+#analysis.saveParametersToTable(sim.dbName)
+stop_replicationResults = stop_sim.runReplications('config files/stop.yml', processResult=processResult)
+for seed, (minDistances, minTTCs, PETs, interactionNums) in zip(seeds, stop_replicationResults):
+    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
+    # stop_analysis.seed = seed
+    #stop.saveIndicators(sim.dbName)
+    for categoryNum in minDistances:
+        stop_minDistances[categoryNum][seed].extend(minDistances[categoryNum])
+        stop_minTTCs[categoryNum].extend(minTTCs[categoryNum])
+    stop_PETs.extend(PETs)
+    stop_interactions.extend((seed, num) for num in interactionNums)
 
     stop_rearEndnInter10.append((np.array(stop_minDistances[1][seed]) <= 10).sum())
     stop_rearEndnInter20.append((np.array(stop_minDistances[1][seed]) <= 20).sum())
@@ -14,7 +14,7 @@ yield_analysis = an.Analysis(idx = 0, world=yield_world, seed=yield_sim.seed)
 yield_analysis.interactions = []
 #an.createAnalysisTable(sim.dbName)
 
-seeds = [yield_sim.seed+i*yield_sim.increment for i in range(yield_sim.rep)]
+seeds = yield_sim.getSeeds()
 yield_minTTCs = {1: [], 2: []}
 yield_minDistances = {1: {}, 2: {}}
 for categoryNum in yield_minDistances:
@@ -22,7 +22,7 @@ for categoryNum in yield_minDistances:
         yield_minDistances[categoryNum][seed] = []  #
 
 yield_PETs = []
-yield_interactions = []
+yield_interactions = []  # (seed, interaction num)
 
 yield_rearEndnInter10 = []
 yield_rearEndnInter20 = []
@@ -33,32 +33,44 @@ yield_sidenInter20 = []
 yield_sidenInter50 = []
 
 
-# analysis.saveParametersToTable(sim.dbName)
-for seed in seeds:
-    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
-    yield_world = network.World.load('config files/yield.yml')
-    yield_sim.seed = seed
-    yield_sim.run(yield_world)
-    yield_analysis.seed = seed
-    yield_analysis.interactions.append(yield_world.completedInteractions)
-    # analysis.saveIndicators(sim.dbName)
-    for inter in yield_world.completedInteractions:
+def processResult(world, sim):
+    '''returns the indicators of the interactions of a replication: minimum distances and TTCs by category,
+    PETs and numbers of the interactions with more than 5 TTC values'''
+    minDistances = {1: [], 2: []}
+    minTTCs = {1: [], 2: []}
+    PETs = []
+    interactionNums = []
+    for inter in world.completedInteractions:
         if inter.categoryNum is not None:
             yield_distance = inter.getIndicator(events.Interaction.indicatorNames[2])
             if yield_distance is not None:
-                yield_minDistances[inter.categoryNum][seed].append(yield_distance.getMostSevereValue(1))
+                minDistances[inter.categoryNum].append(yield_distance.getMostSevereValue(1))
             yield_ttc = inter.getIndicator(events.Interaction.indicatorNames[7])
             if yield_ttc is not None:
-                yield_minTTC = yield_ttc.getMostSevereValue(1)*yield_sim.timeStep  # seconds
+                yield_minTTC = yield_ttc.getMostSevereValue(1)*sim.timeStep  # seconds
                 if yield_minTTC < 0:
                     print(inter.num, inter.categoryNum, yield_ttc.values)
                 if yield_minTTC < 20:
-                    yield_minTTCs[inter.categoryNum].append(yield_minTTC)
+                    minTTCs[inter.categoryNum].append(yield_minTTC)
                 values = yield_ttc.getValues(False)
                 if len(values) > 5:
-                    yield_interactions.append(inter)
+                    interactionNums.append(inter.num)
             if inter.getIndicator(events.Interaction.indicatorNames[10]) is not None:
-                yield_PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+                PETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1))
+    return minDistances, minTTCs, PETs, interactionNums
+
+
+# analysis.saveParametersToTable(sim.dbName)
+yield_replicationResults = yield_sim.runReplications('config files/yield.yml', processResult=processResult)
+for seed, (minDistances, minTTCs, PETs, interactionNums) in zip(seeds, yield_replicationResults):
+    print(str(seeds.index(seed)+1) + 'out of {}'.format(len(seeds)))
+    yield_analysis.seed = seed
+    # analysis.saveIndicators(sim.dbName)
+    for categoryNum in minDistances:
+        yield_minDistances[categoryNum][seed].extend(minDistances[categoryNum])
+        yield_minTTCs[categoryNum].extend(minTTCs[categoryNum])
+    yield_PETs.extend(PETs)
+    yield_interactions.extend((seed, num) for num in interactionNums)
 
     yield_rearEndnInter10.append((np.array(yield_minDistances[1][seed]) <= 10).sum())
     yield_rearEndnInter20.append((np.array(yield_minDistances[1][seed]) <= 20).sum())
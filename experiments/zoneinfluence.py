@@ -9,76 +9,43 @@ import toolkit
 
 world = network.World.load('config files/cross-net.yml')
 sim = simulation.Simulation.load('config files/config.yml')
-seeds = [sim.seed+i*sim.increment for i in range(sim.rep)]
-surfaces = [2000]#, 7000, 15000]
-surface = surfaces[0]
+seeds = sim.getSeeds()
+surfaces = [2000, 7000, 15000]  # the passages in all zones are recorded in the same simulations
 
-PETs = {surface: []}#, 7000: [], 15000: []}
-interactions = {surface: []}# = {2000: [], 7000: [], 15000: []}
+PETs = {surface: [] for surface in surfaces}
+interactions = {surface: [] for surface in surfaces}  # (seed, subinteraction num)
 
-rearEndnInter10 = {surface: []}# = {2000: [], 7000: [], 15000: []}
-rearEndnInter20 = {surface: []}#{2000: [], 7000: [], 15000: []}
-rearEndnInter50 = {surface: []}#, 7000: [], 15000: []}
+rearEndnInter10 = {surface: [] for surface in surfaces}
+rearEndnInter20 = {surface: [] for surface in surfaces}
+rearEndnInter50 = {surface: [] for surface in surfaces}
 
-sidenInter10 = {surface: []}#, 7000: [], 15000: []}
-sidenInter20 = {surface: []}#, 7000: [], 15000: []}
-sidenInter50 = {surface: []}#, 7000: [], 15000: []}
+sidenInter10 = {surface: [] for surface in surfaces}
+sidenInter20 = {surface: [] for surface in surfaces}
+sidenInter50 = {surface: [] for surface in surfaces}
 
-minDistances = {surface: {1: {}, 2: {}}}#, 7000: {1: {}, 2: {}}, 15000: {1: {}, 2: {}}}
+minDistances = {surface: {1: {}, 2: {}} for surface in surfaces}
 
-minTTCs = {surface: {1: {}, 2: {}}}# {2000: {1: {}, 2: {}}, 7000: {1: {}, 2: {}}, 15000: {1: {}, 2: {}}}
+minTTCs = {surface: {1: {}, 2: {}} for surface in surfaces}
 nInter10 = {}
 nInter20 = {}
 nInter50 = {}
 
-analysisList = []
 
+def processResult(world, sim):
+    '''returns, for each analysis zone surface, the indicators of the subinteractions in the zone of a replication:
+    minimum distances and TTCs by category, PETs and numbers of the subinteractions with more than 5 TTC values'''
+    results = {}
+    for surface in surfaces:
+        analysisZone = an.AnalysisZone(world.intersections[0], surface)
+        zoneMinDistances = {1: [], 2: []}
+        zoneMinTTCs = {1: [], 2: []}
+        zonePETs = []
+        interactionNums = []
+        filteredInteractions = list(filter(lambda x: x.categoryNum is not None, world.completedInteractions))
 
-for seed in seeds:
-    print('run {} out of {}'.format(seeds.index(seed) + 1, len(seeds)))
-    world = network.World.load('config files/cross-net.yml')
-    sim.seed = seed
-    sim.run(world, surface)
-    analysis = an.Analysis(idx=0, world=world, seed=seed)
-    analysis.interactions = world.completedInteractions
-    analysisList.append(analysis)
-
-for surface in surfaces:
-    print(surface)
-    analysisZone = an.AnalysisZone(world.intersections[0], surface)
-
-    PETs[surface] = {}
-    minTTCs[surface][1] = {}
-    minTTCs[surface][2] = {}
-    minDistances[surface][1] = {}
-    minDistances[surface][2] = {}
-
-    for analysis in analysisList:
-        PETs[surface][analysis.seed] = []
-        minTTCs[surface][1][analysis.seed] = []
-        minTTCs[surface][2][analysis.seed] = []
-        minDistances[surface][1][analysis.seed] = []
-        minDistances[surface][2][analysis.seed] = []
-        filteredAnalysis = list(filter(lambda x: x.categoryNum is not None, analysis.interactions))
-
-        for inter in filteredAnalysis:
-            print(str(analysisList.index(analysis) + 1) + 'out of' + str(len(analysisList)))
-            print(str(filteredAnalysis.index(inter) + 1) + '/' + str(len(filteredAnalysis)))
-
-            roadUser1TimeIntervalInAnalysisZone = inter.roadUser1.timeIntervalInAnalysisZone
-            roadUser2TimeIntervalInAnalysisZone = inter.roadUser2.timeIntervalInAnalysisZone
-
-            if roadUser1TimeIntervalInAnalysisZone.first == 0:
-                roadUser1TimeIntervalInAnalysisZone = None
-            else:
-                if roadUser1TimeIntervalInAnalysisZone.last == -1:
-                    roadUser1TimeIntervalInAnalysisZone.last = float('inf')
-
-            if roadUser2TimeIntervalInAnalysisZone.first == 0:
-                roadUser2TimeIntervalInAnalysisZone = None
-            else:
-                if roadUser2TimeIntervalInAnalysisZone.last == -1:
-                    roadUser2TimeIntervalInAnalysisZone.last = float('inf')
+        for inter in filteredInteractions:
+            roadUser1TimeIntervalInAnalysisZone = analysisZone.getUserInterval(inter.roadUser1, surface)
+            roadUser2TimeIntervalInAnalysisZone = analysisZone.getUserInterval(inter.roadUser2, surface)
 
             if roadUser1TimeIntervalInAnalysisZone is not None and roadUser2TimeIntervalInAnalysisZone is not None:
                 usersIntervalInAnalysisZone = moving.TimeInterval.intersection(roadUser1TimeIntervalInAnalysisZone, roadUser2TimeIntervalInAnalysisZone)
@@ -87,7 +54,7 @@ for surface in surfaces:
 
                     distance = subInteraction.getIndicator(events.Interaction.indicatorNames[2])
                     if distance is not None:
-                        minDistances[surface][subInteraction.categoryNum][analysis.seed].append(min(distance.getValues(False)))
+                        zoneMinDistances[subInteraction.categoryNum].append(min(distance.getValues(False)))
 
                     ttc = subInteraction.getIndicator(events.Interaction.indicatorNames[7])
                     if ttc is not None:
@@ -96,26 +63,41 @@ for surface in surfaces:
                             if minTTC < 0:
                                 print(subInteraction.num, subInteraction.categoryNum, ttc.values)
                             if minTTC < 20:
-                                minTTCs[surface][subInteraction.categoryNum][analysis.seed].append(minTTC)
+                                zoneMinTTCs[subInteraction.categoryNum].append(minTTC)
                             values = ttc.getValues(False)
                             if len(values) > 5:
-                                interactions[surface].append(subInteraction)
+                                interactionNums.append(subInteraction.num)
                     if subInteraction.getIndicator(events.Interaction.indicatorNames[10]) is not None:
-                        PETs[surface][analysis.seed].append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1) * sim.timeStep)
+                        zonePETs.append(inter.getIndicator(events.Interaction.indicatorNames[10]).getMostSevereValue(1) * sim.timeStep)
+        results[surface] = (zoneMinDistances, zoneMinTTCs, zonePETs, interactionNums)
+    return results
 
 
-        sidenInter10[surface].append((np.array(minDistances[surface][2][analysis.seed]) <= 10).sum())
-        sidenInter20[surface].append((np.array(minDistances[surface][2][analysis.seed]) <= 20).sum())
-        sidenInter50[surface].append((np.array(minDistances[surface][2][analysis.seed]) <= 50).sum())
+replicationResults = sim.runReplications('config files/cross-net.yml', surfaces, processResult=processResult)
+
+for surface in surfaces:
+    print(surface)
+    PETs[surface] = {}
+    for seed, results in zip(seeds, replicationResults):
+        zoneMinDistances, zoneMinTTCs, PETs[surface][seed], interactionNums = results[surface]
+        for categoryNum in zoneMinDistances:
+            minDistances[surface][categoryNum][seed] = zoneMinDistances[categoryNum]
+            minTTCs[surface][categoryNum][seed] = zoneMinTTCs[categoryNum]
+        interactions[surface].extend((seed, num) for num in interactionNums)
+
+        sidenInter10[surface].append((np.array(minDistances[surface][2][seed]) <= 10).sum())
+        sidenInter20[surface].append((np.array(minDistances[surface][2][seed]) <= 20).sum())
+        sidenInter50[surface].append((np.array(minDistances[surface][2][seed]) <= 50).sum())
 
-        rearEndnInter10[surface].append((np.array(minDistances[surface][1][analysis.seed]) <= 10).sum())
-        rearEndnInter20[surface].append((np.array(minDistances[surface][1][analysis.seed]) <= 20).sum())
-        rearEndnInter50[surface].append((np.array(minDistances[surface][1][analysis.seed]) <= 50).sum())
+        rearEndnInter10[surface].append((np.array(minDistances[surface][1][seed]) <= 10).sum())
+        rearEndnInter20[surface].append((np.array(minDistances[surface][1][seed]) <= 20).sum())
+        rearEndnInter50[surface].append((np.array(minDistances[surface][1][seed]) <= 50).sum())
 
     nInter10[surface] = {1: np.mean(rearEndnInter10[surface]), 2: np.mean(sidenInter10[surface])}
     nInter20[surface] = {1: np.mean(rearEndnInter20[surface]), 2: np.mean(sidenInter20[surface])}
     nInter50[surface] = {1: np.mean(rearEndnInter50[surface]), 2: np.mean(sidenInter50[surface])}
 
+surface = '-'.join(str(s) for s in surfaces)
 toolkit.saveYaml('zone{}-nInter10.yml'.format(surface), nInter10)
 toolkit.saveYaml('zone{}-nInter20.yml'.format(surface), nInter20)
 toolkit.saveYaml('zone{}-nInter50.yml'.format(surface), nInter50)
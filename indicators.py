@@ -1,9 +1,11 @@
 #! /usr/bin/env python
 '''Class for indicators, temporal indicators, and safety indicators'''
 
+from collections.abc import MutableMapping
+from numbers import Real
+
 from matplotlib.pyplot import plot, ylim
-from numpy import arange, floor, mean
-from scipy import percentile
+from numpy import arange, argmax, argmin, array, bincount, ceil, concatenate, count_nonzero, cumsum, empty, flatnonzero, floor, full, insert, lexsort, mean, minimum, nan, newaxis, partition, percentile, repeat, searchsorted, sort, where, zeros
 
 from trafficintelligence import moving
 from trafficintelligence.utils import LCSS as utilsLCSS
@@ -13,6 +15,45 @@ def multivariateName(indicatorNames):
     return '_'.join(indicatorNames)
 
 
+class IndicatorValues(MutableMapping):
+    '''Dict view of the values of a temporal indicator (compatibility with the dict API):
+    instant -> value (None for the instants set to None), in increasing order'''
+
+    def __init__(self, indicator):
+        self.indicator = indicator
+
+    def __getitem__(self, t):
+        if t not in self:
+            raise KeyError(t)
+        return self.indicator[t]
+
+    def get(self, t, default=None):
+        if t in self:
+            return self.indicator[t]
+        else:
+            return default
+
+    def __setitem__(self, t, value):
+        self.indicator.setValue(t, value)
+
+    def __delitem__(self, t):
+        if t not in self:
+            raise KeyError(t)
+        self.indicator.removeInstant(t)
+
+    def __contains__(self, t):
+        return self.indicator.hasInstant(t)
+
+    def __iter__(self):
+        return iter(self.indicator.getInstants())
+
+    def __len__(self):
+        return self.indicator.nInstants
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 # need for a class representing the indicators, their units, how to print them in graphs...
 class TemporalIndicator(object):
     '''Class for temporal indicators
@@ -22,53 +63,225 @@ class TemporalIndicator(object):
     * a dict, for the values at specific time instants
     * or a list with a time interval object if continuous measurements
 
+    the values are stored in an array ordered by instant, data[i] being the value at instant offset+i
+    (offset is timeInterval.first, the instants are offset plus an integer),
+    missing values are NaN in data and False in the boolean array present
+    the instants of the indicator are True in the boolean array isInstant:
+    as with the dict of values, an instant set to None is an instant of the indicator (counted by len)
+    with a missing value (not counted by the value computations, eg getMostSevereValue)
+    if some instants are not offset plus an integer (eg PET instants), data[i] is the value at instant instants[i]
+    (object array keeping the instants as given, None otherwise)
+    values is a dict view of the values (see IndicatorValues)
+
     it should have more information like name, unit'''
 
     def __init__(self, name, values, timeInterval=None, maxValue=None):
         self.name = name
+        self.offset = None
+        self.n = 0  # length of the stored interval
+        self.nValues = 0
+        self.nInstants = 0
+        self.data = empty(0)
+        self.present = zeros(0, dtype=bool)
+        self.isInstant = zeros(0, dtype=bool)
+        self.objectValues = False  # data is an object array if some values are not numbers (eg lists)
+        self.instants = None
+        self.timeInterval = moving.TimeInterval()
         if timeInterval is None:
-            self.values = values
-            instants = sorted(self.values.keys())
+            instants = sorted(values.keys())
             if len(instants) > 0:
-                self.timeInterval = moving.TimeInterval(instants[0], instants[-1])
-            else:
-                self.timeInterval = moving.TimeInterval()
+                if self.isAligned(instants[-1], instants[0]):
+                    self.reserve(instants[0], instants[-1])
+                for t in instants:
+                    self.setValue(t, values[t])
         else:
             assert len(values) == timeInterval.length()
+            n = int(round(timeInterval.length()))
+            if n > 0:
+                self.reserve(timeInterval.first, timeInterval.first + n - 1)
+                for i in range(n):
+                    self.setValue(timeInterval[i], values[i])
             self.timeInterval = timeInterval
-            self.values = {}
-            for i in range(int(round(self.timeInterval.length()))):
-                self.values[self.timeInterval[i]] = values[i]
         self.maxValue = maxValue
 
+    def reserve(self, first, last):
+        '''extends the stored interval to include [first, last]'''
+        if self.offset is None:
+            self.offset = first
+            self.timeInterval.first = first
+            self.timeInterval.last = first
+            self.n = 1
+            self.data = full(max(int(last - first) + 1, 1), nan, dtype=self.data.dtype)
+            self.present = zeros(len(self.data), dtype=bool)
+            self.isInstant = zeros(len(self.data), dtype=bool)
+        if first < self.offset:
+            shift = self.getArrayIndex(first - self.offset)
+            self.data = concatenate((full(-shift, nan, dtype=self.data.dtype), self.data))
+            self.present = concatenate((zeros(-shift, dtype=bool), self.present))
+            self.isInstant = concatenate((zeros(-shift, dtype=bool), self.isInstant))
+            self.offset = first
+            self.n -= shift
+        n = self.getArrayIndex(last - self.offset) + 1
+        if n > len(self.data):
+            capacity = max(n, 2 * len(self.data))
+            self.data = concatenate((self.data, full(capacity - len(self.data), nan, dtype=self.data.dtype)))
+            self.present = concatenate((self.present, zeros(capacity - len(self.present), dtype=bool)))
+            self.isInstant = concatenate((self.isInstant, zeros(capacity - len(self.isInstant), dtype=bool)))
+        self.n = max(self.n, n)
+
+    @staticmethod
+    def getArrayIndex(di):
+        i = int(di)
+        if i != di:
+            raise ValueError('instant {} is not aligned with the instants of the indicator'.format(di))
+        return i
+
+    @staticmethod
+    def isAligned(t, offset):
+        return offset is None or int(t - offset) == t - offset
+
+    def storeInstants(self, t):
+        '''stores the values by instant (see instants) and inserts instant t, returns its index'''
+        if self.instants is None:
+            indices = flatnonzero(self.isInstant[:self.n])
+            if self.offset is None:
+                self.instants = empty(0, dtype=object)
+            else:
+                self.instants = array((self.offset + indices).tolist(), dtype=object)
+            self.data = self.data[indices]
+            self.present = self.present[indices]
+            self.isInstant = self.isInstant[indices]
+            self.n = len(indices)
+        i = int(searchsorted(self.instants, t))
+        self.instants = insert(self.instants, i, t)
+        self.data = insert(self.data, i, nan)
+        self.present = insert(self.present, i, False)
+        self.isInstant = insert(self.isInstant, i, False)
+        self.n += 1
+        self.offset = self.instants[0]
+        return i
+
+    def getInstantsAt(self, indices):
+        '''returns the instants at indices (integer or array) in the arrays'''
+        if self.instants is None:
+            return self.offset + indices
+        else:
+            return self.instants[indices]
+
+    def getIndex(self, t):
+        '''returns the index of instant t in the arrays, None if outside of the stored interval'''
+        if self.offset is None or t is None:
+            return None
+        if self.instants is not None:
+            i = int(searchsorted(self.instants, t))
+            if i < self.n and self.instants[i] == t:
+                return i
+            return None
+        i = t - self.offset
+        if 0 <= i < self.n:
+            if type(i) is int:
+                return i
+            elif int(i) == i:
+                return int(i)
+        return None
+
+    def setValue(self, t, value):
+        '''sets the value at instant t (None for a missing value)'''
+        i = self.getIndex(t)
+        if i is None and self.instants is None and self.offset is not None and t == self.offset + self.n and self.n < len(self.data):  # next instant
+            i = self.n
+            self.n += 1
+        elif i is None and (self.instants is not None or not self.isAligned(t, self.offset)):
+            i = self.storeInstants(t)
+        elif i is None:
+            self.reserve(min(t, self.offset) if self.offset is not None else t, max(t, self.offset + self.n - 1) if self.offset is not None else t)
+            i = self.getIndex(t)
+        if not self.isInstant[i]:
+            self.nInstants += 1
+            self.isInstant[i] = True
+        if value is None:
+            if self.present[i]:
+                self.nValues -= 1
+                self.present[i] = False
+                self.data[i] = nan
+        else:
+            if not self.objectValues and type(value) is not float and not isinstance(value, Real):
+                self.data = self.data.astype(object)
+                self.objectValues = True
+            self.data[i] = value
+            if not self.present[i]:
+                self.nValues += 1
+                self.present[i] = True
+        if t < self.timeInterval.first:
+            self.timeInterval.first = t
+        if t > self.timeInterval.last:
+            self.timeInterval.last = t
+
+    def hasInstant(self, t):
+        i = self.getIndex(t)
+        return i is not None and bool(self.isInstant[i])
+
+    def removeInstant(self, t):
+        '''removes instant t and its value'''
+        if self.hasInstant(t):
+            self.setValue(t, None)
+            i = self.getIndex(t)
+            self.isInstant[i] = False
+            self.nInstants -= 1
+
+    @property
+    def values(self):
+        return IndicatorValues(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = self.data[:self.n].copy()
+        state['present'] = self.present[:self.n].copy()
+        state['isInstant'] = self.isInstant[:self.n].copy()
+        return state
+
     def __len__(self):
-        return len(self.values)
+        return self.nInstants
 
     def empty(self):
-        return len(self.values) == 0
+        return self.nInstants == 0
 
     def __getitem__(self, t):
         'Returns the value at time t'
-        return self.values.get(t)
+        i = self.getIndex(t)
+        if i is None or not self.present[i]:
+            return None
+        elif self.objectValues:
+            return self.data[i]
+        else:
+            return float(self.data[i])
+
+    def getPresentIndices(self):
+        return flatnonzero(self.present[:self.n])
+
+    def getInstantIndices(self):
+        return flatnonzero(self.isInstant[:self.n])
 
     def getIthValue(self, i):
-        sortedKeys = sorted(self.values.keys())
-        if 0 <= i < len(sortedKeys):
-            return self.values[sortedKeys[i]]
+        if 0 <= i < self.nInstants:
+            if self.nInstants == self.n:
+                return self[self.getInstantsAt(i)]
+            else:
+                return self[self.getInstantsAt(self.getInstantIndices()[i])]
         else:
             return None
 
     def __iter__(self):
-        self.iterInstantNum = 0  # index in the interval or keys of the dict
+        self.iterIndices = self.getInstantIndices()
+        self.iterInstantNum = 0  # index in the instants
         return self
 
     def __next__(self):
-        if self.iterInstantNum >= len(self.values):  # (self.timeInterval and self.iterInstantNum>=self.timeInterval.length())\
-            #     or (self.iterInstantNum >= self.values)
+        if self.iterInstantNum >= len(self.iterIndices):
             raise StopIteration
         else:
             self.iterInstantNum += 1
-            return self.getIthValue(self.iterInstantNum - 1)
+            return self[self.getInstantsAt(self.iterIndices[self.iterInstantNum - 1])]
 
     def getTimeInterval(self):
         return self.timeInterval
@@ -76,23 +289,99 @@ class TemporalIndicator(object):
     def getName(self):
         return self.name
 
+    def getValuesArray(self):
+        '''returns the array of the values over the stored interval, NaN for missing values (view, do not modify)'''
+        return self.data[:self.n]
+
     def getValues(self, withNone=True):
-        result = [self.__getitem__(t) for t in self.timeInterval]
-        if withNone:
-            return result
+        if self.n == 0:
+            return []
+        if withNone and self.instants is not None:
+            return [self[t] for t in self.timeInterval]
+        elif withNone:
+            result = where(self.present[:self.n], self.data[:self.n], None).tolist()
+            # instants of the time interval outside of the stored interval
+            return [None] * max(0, int(self.offset - self.timeInterval.first)) + result + [None] * max(0, int(self.timeInterval.last - (self.offset + self.n - 1)))
         else:
-            return [x for x in result if x is not None]
+            return self.data[:self.n][self.present[:self.n]].tolist()
 
     def getInstants(self):
-        return list(self.values.keys())
+        if self.n == 0:
+            return []
+        else:
+            return self.getInstantsAt(self.getInstantIndices()).tolist()
+
+    def getSubIndicator(self, timeInterval, copy=False):
+        '''returns an indicator with the values in timeInterval
+        by default, it is a view sharing the arrays of self (read only), only the bounds of the window are stored'''
+        sub = self.__class__.__new__(self.__class__)
+        sub.__dict__.update(self.__dict__)
+        sub.offset = None
+        sub.n = 0
+        sub.nValues = 0
+        sub.nInstants = 0
+        sub.data = empty(0, dtype=self.data.dtype)
+        sub.present = zeros(0, dtype=bool)
+        sub.isInstant = zeros(0, dtype=bool)
+        sub.instants = None
+        sub.timeInterval = moving.TimeInterval()
+        if self.n > 0:
+            if self.instants is None:
+                i = max(0, int(ceil(timeInterval.first - self.offset)))
+                j = min(self.n, int(floor(timeInterval.last - self.offset)) + 1) if timeInterval.last < self.offset + self.n else self.n
+            else:
+                i = int(searchsorted(self.instants, timeInterval.first))
+                j = int(searchsorted(self.instants, timeInterval.last, side='right'))
+            if i < j:
+                if self.instants is None:
+                    sub.offset = self.offset + i
+                else:
+                    sub.offset = self.instants[i]
+                    sub.instants = self.instants[i:j]
+                sub.n = j - i
+                sub.data = self.data[i:j]
+                sub.present = self.present[i:j]
+                sub.isInstant = self.isInstant[i:j]
+                if copy:
+                    sub.data = sub.data.copy()
+                    sub.present = sub.present.copy()
+                    sub.isInstant = sub.isInstant.copy()
+                    if sub.instants is not None:
+                        sub.instants = sub.instants.copy()
+                else:
+                    sub.data.flags.writeable = False
+                    sub.present.flags.writeable = False
+                    sub.isInstant.flags.writeable = False
+                sub.nValues = int(count_nonzero(sub.present))
+                sub.nInstants = int(count_nonzero(sub.isInstant))
+                if sub.instants is None:
+                    sub.timeInterval = moving.TimeInterval(sub.offset, sub.offset + sub.n - 1)
+                else:
+                    sub.timeInterval = moving.TimeInterval(sub.offset, sub.instants[-1])
+        return sub
+
+    def getMin(self):
+        '''returns the minimum value, None if there is no value'''
+        if self.nValues > 0:
+            return float(self.data[:self.n][self.present[:self.n]].min())
+
+    def getMax(self):
+        '''returns the maximum value, None if there is no value'''
+        if self.nValues > 0:
+            return float(self.data[:self.n][self.present[:self.n]].max())
+
+    def getMean(self):
+        '''returns the mean value, None if there is no value'''
+        if self.nValues > 0:
+            return float(mean(self.data[:self.n][self.present[:self.n]]))
 
     def plot(self, options='', xfactor=1., yfactor=1., timeShift=0, **kwargs):
         if self.getTimeInterval().length() == 1:
             marker = 'o'
         else:
             marker = ''
-        time = sorted(self.values.keys())
-        plot([(x + timeShift) / xfactor for x in time], [self.values[i] / yfactor for i in time], options + marker, **kwargs)
+        time = self.getInstantsAt(self.getPresentIndices()).tolist()
+        plot([(x + timeShift) / xfactor for x in time], [self[i] / yfactor for i in time], options + marker, **kwargs)
         if self.maxValue:
             ylim(ymax=self.maxValue)
 
@@ -107,12 +396,12 @@ class TemporalIndicator(object):
             return None
 
         timeInterval = moving.TimeInterval.unionIntervals([indic.getTimeInterval() for indic in indicators])
+        instants = [timeInterval[i] for i in range(int(timeInterval.length()))]
+        valueLists = [[indic[t] for t in instants] for indic in indicators]
         values = {}
-        for t in timeInterval:
-            tmpValues = [indic[t] for indic in indicators]
-            uniqueValues = set(tmpValues)
-            if len(uniqueValues) >= 2 or uniqueValues.pop() is not None:
-                values[t] = tmpValues
+        for t, tmpValues in zip(instants, zip(*valueLists)):
+            if any(v is not None for v in tmpValues):
+                values[t] = list(tmpValues)
         return cls(multivariateName([indic.name for indic in indicators]), values)
 
 
@@ -178,25 +467,103 @@ class SeverityIndicator(TemporalIndicator):
         or if centile is not None the n% centile from the most severe value
 
         eg for TTC, centile = 15 returns the 15th centile (value such that 15% of observations are lower)'''
-        values = list(self.values.values())
+        values = self.data[:self.n][self.present[:self.n]]
         if centile is not None:
             if self.mostSevereIsMax:
                 c = 100 - centile
             else:
                 c = centile
             return percentile(values, c)
-        elif minNInstants is not None and minNInstants <= self.__len__():
-            values = sorted(values, reverse=self.mostSevereIsMax)  # inverted if most severe is max -> take the first values
+        elif minNInstants is not None and minNInstants <= len(values):
+            if minNInstants < len(values):
+                if self.mostSevereIsMax:
+                    values = partition(values, len(values) - minNInstants)[len(values) - minNInstants:]
+                else:
+                    values = partition(values, minNInstants - 1)[:minNInstants]
+            values = sort(values)
+            if self.mostSevereIsMax:  # inverted if most severe is max -> take the first values
+                values = values[::-1]
             return mean(values[:minNInstants])
         else:
             return None
 
     def getInstantOfMostSevereValue(self):
         '''Returns the instant at which the indicator reaches its most severe value'''
+        indices = self.getPresentIndices()
+        values = self.data[indices]
         if self.mostSevereIsMax:
-            return max(self.values, key=self.values.get)
+            i = argmax(values)
         else:
-            return min(self.values, key=self.values.get)
+            i = argmin(values)
+        return self.getInstantsAt(indices[i:i+1]).tolist()[0]
+
+
+def concatenateIndicators(indicators):
+    '''Returns the ragged representation of the values of a list of temporal indicators (None for no indicator):
+    the arrays of all values (missing values removed) and of their instants, in the order of the indicators,
+    and the array of the number of values of each indicator'''
+    values = []
+    instants = []
+    lengths = zeros(len(indicators), dtype=int)
+    for k, indicator in enumerate(indicators):
+        if indicator is not None and indicator.nValues > 0:
+            indices = indicator.getPresentIndices()
+            values.append(indicator.data[indices].astype(float))
+            instants.append(indicator.getInstantsAt(indices).astype(float))
+            lengths[k] = len(indices)
+    if len(values) > 0:
+        return concatenate(values), concatenate(instants), lengths
+    else:
+        return empty(0), empty(0), lengths
+
+
+def getSeveritySummaries(indicators, mostSevereIsMax=False, minNInstants=1, centiles=[], threshold=None):
+    '''Computes in one vectorised pass the summaries of a list of severity indicators (None for no indicator)
+    returns the arrays (one item per indicator)
+    - of the most severe values (average of the minNInstants most severe values as in SeverityIndicator.getMostSevereValue)
+    - of the instants of the most severe value (first instant if several)
+    - of the centiles (one column per centile, as in SeverityIndicator.getMostSevereValue)
+    - of the number of values smaller than or equal to threshold (if threshold is not None)
+    NaN for the indicators with no (or less than minNInstants) values'''
+    values, instants, lengths = concatenateIndicators(indicators)
+    nIndicators = len(lengths)
+    segments = repeat(arange(nIndicators), lengths)
+    starts = concatenate(([0], cumsum(lengths)[:-1])).astype(int)
+    # sort by indicator, then by severity, then by instant
+    if mostSevereIsMax:
+        order = lexsort((instants, -values, segments))
+    else:
+        order = lexsort((instants, values, segments))
+    sortedValues = values[order]
+    hasValues = lengths > 0
+    mostSevereValues = full(nIndicators, nan)
+    mostSevereInstants = full(nIndicators, nan)
+    mostSevereInstants[hasValues] = instants[order][starts[hasValues]]
+    enough = lengths >= minNInstants
+    mostSevereValues[enough] = mean(sortedValues[starts[enough][:, newaxis] + arange(minNInstants)], axis=1)
+    centileValues = full((nIndicators, len(centiles)), nan)
+    if len(centiles) > 0 and hasValues.any():
+        # values in increasing order within each indicator
+        ascendingValues = values[lexsort((values, segments))]
+        n = lengths[hasValues]
+        for j, centile in enumerate(centiles):
+            if mostSevereIsMax:
+                c = 100 - centile
+            else:
+                c = centile
+            virtualIndices = c / 100. * (n - 1)
+            lower = floor(virtualIndices).astype(int)
+            upper = minimum(lower + 1, n - 1)
+            t = virtualIndices - lower
+            a = ascendingValues[starts[hasValues] + lower]
+            b = ascendingValues[starts[hasValues] + upper]
+            diff = b - a
+            centileValues[hasValues, j] = where(t >= 0.5, b - diff * (1 - t), a + diff * t)  # same interpolation as numpy.percentile
+    if threshold is None:
+        nBelowThreshold = None
+    else:
+        nBelowThreshold = bincount(segments, weights=(values <= threshold), minlength=nIndicators).astype(int)
+    return mostSevereValues, mostSevereInstants, centileValues, nBelowThreshold
 
 
 # functions to aggregate discretized maps of indicators
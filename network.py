@@ -1,13 +1,21 @@
+import gzip
+import heapq
+import itertools
+import pickle
 import sqlite3
+from bisect import bisect_left, bisect_right
+from math import floor, sqrt
 
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 from scipy import stats
-from trafficintelligence import utils, moving, indicators
+from trafficintelligence import utils, moving
 
 import agents
+import analysis
 import events
+import indicators
 import toolkit
 
 
@@ -47,7 +55,7 @@ class Alignment:
             # TODO use proportions at connection
             # TODO check control devices
             cd = self.getControlDevice()
-            nextAlignment = self.drawNextAlignment()
+            nextAlignment = self.drawNextAlignment(user)
             if cd is not None:
                 user.setArrivalInstantAtControlDevice(instant)
                 if cd.permissionToGo(instant, user, world):
@@ -73,16 +81,51 @@ class Alignment:
     def getIdx(self):
         return self.idx
 
+    def initSegments(self):
+        '''precomputes the segments of the alignment for getXYfromSY (after computing the cumulative distances):
+        cumulative distance at their origin, origin, unit direction vector and normal'''
+        x = np.array(self.points.positions[0], dtype=float)
+        y = np.array(self.points.positions[1], dtype=float)
+        dx = x[1:] - x[:-1]
+        dy = y[1:] - y[:-1]
+        norms = np.sqrt(dx**2 + dy**2)
+        self.cumulativeDistances = np.array(self.points.cumulativeDistances)
+        self.segmentOrigins = np.column_stack((x[:-1], y[:-1]))
+        self.segmentDirections = np.column_stack((dx/norms, dy/norms))
+        self.segmentNormals = np.column_stack((dy/norms, -dx/norms))
+
+    def getXYfromSY(self, s, y):
+        '''returns the coordinates (array of shape (2,) or (n, 2)) of the positions (s, y) on the alignment
+        (numbers or arrays), like moving.getXYfromSY
+        the positions past the end of the alignment are nan'''
+        s = np.asarray(s, dtype=float)
+        y = np.asarray(y, dtype=float)
+        i = np.maximum(np.searchsorted(self.cumulativeDistances, s, side='left'), 1) - 1
+        pastEnd = i >= len(self.segmentOrigins)
+        i = np.minimum(i, len(self.segmentOrigins)-1)
+        d = s - self.cumulativeDistances[i]
+        xy = self.segmentOrigins[i] + self.segmentDirections[i]*d[..., np.newaxis] + self.segmentNormals[i]*y[..., np.newaxis]
+        xy[pastEnd] = np.nan
+        return xy
+
     def getEntryNode(self):
         return self.entryNode
 
     def getExitNode(self):
         return self.exitNode
 
-    def initConnectedAlignmentDistribution(self):
+    def initConnectedAlignmentDistribution(self, seed=None):
+        '''initializes the cumulative table of movement proportions to the connected alignments
+        and the stream of uniform variates used to draw them
+        (its generator is seeded from seed and the alignment index, in a different namespace
+        than the user input streams)'''
         connectedAlignmentIndices = self.getConnectedAlignmentIndices()
         if connectedAlignmentIndices is not None:
-            self.connectedAlignmentDistribution = stats.rv_discrete(name='custm', values=(list(range(len(connectedAlignmentIndices))), self.getConnectedAlignmentMovementProportions()))
+            cumulativeProportions = np.cumsum(self.getConnectedAlignmentMovementProportions())
+            self.connectedAlignmentCumulativeProportions = (cumulativeProportions / cumulativeProportions[-1]).tolist()
+            if seed is None:
+                seed = np.random.randint(np.iinfo(np.int32).max)
+            self.connectedAlignmentStream = VariateStream(stats.uniform(), np.random.default_rng(np.random.SeedSequence([seed, self.idx], spawn_key=(1,))))
 
     def getConnectedAlignmentMovementProportion(self, i):
         if self.connectedAlignmentIndices is None:
@@ -114,12 +157,23 @@ class Alignment:
     def getTransversalAlignments(self):
         return self.getTransversalAlignments
 
-    def drawNextAlignment(self):
-        return self.connectedAlignments[self.connectedAlignmentDistribution.rvs()]
+    def drawNextAlignment(self, user=None):
+        '''draws the next alignment from the movement proportions
+        if user is provided, the draw is memorized so that the user keeps the same next alignment
+        (eg while waiting at a control device) until it leaves the alignment (see NewellMovingObject.addVisitedAlignment)'''
+        if user is not None and self.idx in user.nextAlignmentDraws:
+            return self.connectedAlignments[user.nextAlignmentDraws[self.idx]]
+        i = min(bisect_right(self.connectedAlignmentCumulativeProportions, self.connectedAlignmentStream.rvs()), len(self.connectedAlignments) - 1)
+        if user is not None:
+            user.nextAlignmentDraws[self.idx] = i
+        return self.connectedAlignments[i]
 
     def getUsersOnAlignmentAtInstant(self, instant):
-        '''returns users on alignment at instant'''
-        if instant in self.currentUsers:
+        '''returns users on alignment at instant
+        (by ascending curvilinear position from the occupancy if instant is its last update)'''
+        if instant is not None and instant == self.occupancyInstant:
+            return list(self.occupancy)
+        elif instant in self.currentUsers:
             return self.currentUsers[instant]
         else:
             return []
@@ -166,6 +220,78 @@ class Alignment:
     def getFirstUser(self):
         return self.firstUser
 
+    def initOccupancy(self):
+        '''initializes the list of users currently on the alignment,
+        ordered by ascending curvilinear position (the last one is the first user),
+        with their positions at the last update (occupancyInstant, see updateOccupancy)'''
+        self.occupancy = []
+        self.occupancyPositions = []
+        self.occupancyInstant = None
+
+    def addUser(self, user):
+        '''inserts user in the users currently on the alignment, at the rank of its last curvilinear position'''
+        s = user.curvilinearPositions.getSCoordAt(-1)
+        i = bisect_right(self.occupancyPositions, s)
+        self.occupancy.insert(i, user)
+        self.occupancyPositions.insert(i, s)
+
+    def removeUser(self, user):
+        '''removes user from the users currently on the alignment
+        users leave at the downstream end, so the search starts from the first user'''
+        i = len(self.occupancy) - 1
+        while i >= 0 and self.occupancy[i] is not user:
+            i -= 1
+        if i >= 0:
+            del self.occupancy[i]
+            del self.occupancyPositions[i]
+
+    def updateOccupancy(self, instant=None):
+        '''updates the positions of the users on the alignment at instant and the first user
+        the order is only restored if users passed each other (the users generally follow each other)'''
+        self.occupancyPositions = [u.curvilinearPositions.getSCoordAt(-1) for u in self.occupancy]
+        if any(s1 > s2 for s1, s2 in zip(self.occupancyPositions, self.occupancyPositions[1:])):
+            self.occupancy.sort(key=lambda u: u.curvilinearPositions.getSCoordAt(-1))
+            self.occupancyPositions.sort()
+        self.occupancyInstant = instant
+        if len(self.occupancy) > 0:
+            self.firstUser = self.occupancy[-1]
+
+    def getUsersBetween(self, s1, s2):
+        '''returns the users on the alignment with a curvilinear position between s1 and s2 (included)
+        at the last update of the occupancy, by ascending curvilinear position'''
+        return self.occupancy[bisect_left(self.occupancyPositions, s1):bisect_right(self.occupancyPositions, s2)]
+
+    def getOccupancyIndex(self, user):
+        '''returns the index of user in the users on the alignment, None if not on the alignment
+        (found by its position at the last update of the occupancy, else by a linear search)'''
+        if self.occupancyInstant is not None and user.existsAtInstant(self.occupancyInstant):
+            s = user.getCurvilinearPositionAtInstant(self.occupancyInstant)[0]
+            i = bisect_left(self.occupancyPositions, s)
+            while i < len(self.occupancy) and self.occupancyPositions[i] == s:
+                if self.occupancy[i] is user:
+                    return i
+                i += 1
+        for i in range(len(self.occupancy) - 1, -1, -1):
+            if self.occupancy[i] is user:
+                return i
+        return None
+
+    def getUserAhead(self, user):
+        '''returns the user directly downstream of user on the alignment, None if there is none'''
+        i = self.getOccupancyIndex(user)
+        if i is not None and i + 1 < len(self.occupancy):
+            return self.occupancy[i + 1]
+        else:
+            return None
+
+    def getUserBehind(self, user):
+        '''returns the user directly upstream of user on the alignment, None if there is none'''
+        i = self.getOccupancyIndex(user)
+        if i is not None and i > 0:
+            return self.occupancy[i - 1]
+        else:
+            return None
+
     def getExitIntersection(self):
         return self.exitIntersection
 
@@ -332,6 +458,27 @@ class World:
     def __repr__(self):
         return "alignments: {}, control devices: {}, user inputs: {}".format(self.alignments, self.controlDevices, self.userInputs)
 
+    def __getstate__(self):
+        '''the sink is not saved (it may hold an open file or connection)
+        and the flushed users that are still leaders of current users are saved with them'''
+        state = self.__dict__.copy()
+        if hasattr(self, 'users'):
+            state['sink'] = None
+            userNums = set(u.num for u in self.newUsers + self.users + self.completed)
+            state['flushedLeaders'] = [u.leader for u in self.newUsers + self.users + self.completed if u.leader is not None and u.leader.num not in userNums]
+        return state
+
+    def __setstate__(self, state):
+        '''restores the links between users and their leaders, stored by number (see NewellMovingObject.__getstate__)'''
+        flushedLeaders = state.pop('flushedLeaders', [])
+        self.__dict__.update(state)
+        if hasattr(self, 'users'):
+            usersByNum = {u.num: u for u in flushedLeaders + self.newUsers + self.users + self.completed}
+            for u in usersByNum.values():
+                if hasattr(u, 'leaderNum'):
+                    u.leader = usersByNum.get(u.leaderNum)
+                    del u.leaderNum
+
     @staticmethod
     def load(filename):
         """loads a yaml file"""
@@ -341,9 +488,11 @@ class World:
         """saves data to yaml file"""
         toolkit.saveYaml(filename, self)
 
-    def saveCurvilinearTrajectoriesToSqlite(self, db, seed, analysisId):
-        connection = sqlite3.connect(db)
-        saveTrajectoriesToTable(connection, [user for user in self.completed + self.users if user.timeInterval is not None], 'curvilinear', seed, analysisId)
+    def saveCurvilinearTrajectoriesToSqlite(self, db, seed, analysisId, journalMode=None, synchronous=None):
+        with sqlite3.connect(db) as connection:
+            toolkit.setSqlitePragmas(connection, journalMode, synchronous)
+            saveTrajectoriesToTable(connection, [user for user in self.completed + self.users if user.timeInterval is not None], 'curvilinear', seed, analysisId)
+        connection.close()
 
     @staticmethod
     def takeEntry(elem):
@@ -417,26 +566,109 @@ class World:
             #ui.cumulatedHeadways = futureCumulatedHeadways
         return userNum
 
+    def initStepEngine(self):
+        '''users will be updated by the vectorised step engine (see agents.NewellStepEngine)'''
+        self.stepEngine = agents.NewellStepEngine(self)
+
+    def initInteractionEngine(self):
+        '''the indicators of the interactions will be computed by the batched engine (see events.InteractionIndicatorEngine)'''
+        self.interactionEngine = events.InteractionIndicatorEngine(self)
+
+    def initEventDrivenStepping(self):
+        '''the new users are only updated at the instants when they may change (see getNewUsersToUpdate)
+        and the simulation may skip the instants when the network is empty (see isEmpty and getNextInsertionInstant)'''
+        self.eventDriven = True
+        self.lastScheduledNum = -1
+        self.activeNewUsers = []  # new users whose instant at s=0 may be computed at the next instant
+        self.scheduledNewUsers = []  # heap of (first instant after the instant at s=0, num, new user)
+        self.blockedNewUsers = {}  # leader num -> new users waiting for the leader to be inserted
+
+    def scheduleNewUser(self, user):
+        if user.instantAtS0 is not None:
+            heapq.heappush(self.scheduledNewUsers, (floor(user.instantAtS0)+1, user.getNum(), user))
+        elif user.leader is not None and user.leader.curvilinearPositions is None:
+            self.blockedNewUsers.setdefault(user.leader.getNum(), []).append(user)
+        else:
+            self.activeNewUsers.append(user)
+
+    def scheduleGeneratedUsers(self):
+        '''schedules the new users generated since the last call'''
+        i = len(self.newUsers)
+        while i > 0 and self.newUsers[i-1].getNum() > self.lastScheduledNum:
+            i -= 1
+        for u in self.newUsers[i:]:
+            self.scheduleNewUser(u)
+        if len(self.newUsers) > 0:
+            self.lastScheduledNum = max(self.lastScheduledNum, self.newUsers[-1].getNum())
+
+    def getNewUsersToUpdate(self, instant):
+        '''returns the new users that may change at instant, ordered by number:
+        the users whose instant at s=0 can be computed and the users that will be inserted
+        (the other new users are not changed by updateCurvilinearPositions)'''
+        self.scheduleGeneratedUsers()
+        users = self.activeNewUsers
+        self.activeNewUsers = []
+        while len(self.scheduledNewUsers) > 0 and self.scheduledNewUsers[0][0] <= instant:
+            users.append(heapq.heappop(self.scheduledNewUsers)[2])
+        users.sort(key=lambda u: u.getNum())
+        return users
+
+    def isEmpty(self):
+        '''returns True if there is no user in the network and no current interaction'''
+        return len(self.users) == 0 and len(self.interactions) == 0
+
+    def getNextInsertionInstant(self, instant):
+        '''returns the first instant after instant at which a new user may change (event driven stepping),
+        infinity if they are all waiting for their leaders'''
+        self.scheduleGeneratedUsers()
+        if len(self.activeNewUsers) > 0:
+            return instant+1
+        elif len(self.scheduledNewUsers) > 0:
+            return max(self.scheduledNewUsers[0][0], instant+1)
+        else:
+            return float('inf')
+
     def setInserted(self, user):
         self.inserted.append(user)
 
     def setNewlyCompleted(self, user):
         self.newlyCompleted.append(user)
 
+    def addIntersectionCrossing(self, user, intersection):
+        '''records that user entered intersection during the current step (see updatePET)'''
+        self.intersectionCrossings.append((user, intersection))
+
     def updateUsers(self, instant, analysisZone=None):
         self.newlyCompleted = []
         self.inserted = []
-        for u in self.newUsers + self.users:
-            u.updateCurvilinearPositions(instant, self)
-            if analysisZone is not None:
-                if u.timeInterval is not None:# and u.curvilinearPositions is not None:
-                    if analysisZone.positionInAnalysisZone(u.getCurvilinearPositionAt(-1)):
-                        if u.timeIntervalInAnalysisZone.first == 0:
-                            u.timeIntervalInAnalysisZone.first = instant
-                    else:
-                        if u.timeIntervalInAnalysisZone.first != 0:
-                            if u.timeIntervalInAnalysisZone.last == -1:
-                                u.timeIntervalInAnalysisZone.last = instant - 1
+        self.intersectionCrossings = []
+        self.xyPositions = {}  # the coordinates of the users are cached for the current step
+        if self.eventDriven:
+            newUsers = self.getNewUsersToUpdate(instant)
+        else:
+            newUsers = self.newUsers
+        if self.stepEngine is not None:
+            self.stepEngine.updateUsers(instant)
+        else:
+            for u in newUsers + self.users:
+                u.updateCurvilinearPositions(instant, self)
+        if self.eventDriven:
+            insertedNums = set(u.getNum() for u in self.inserted)
+            for u in newUsers:
+                if u.getNum() in insertedNums:
+                    for follower in self.blockedNewUsers.pop(u.getNum(), []):
+                        self.scheduleNewUser(follower)
+                else:
+                    self.scheduleNewUser(u)
+        if analysisZone is not None:
+            if isinstance(analysisZone, list):
+                analysisZones = analysisZone
+            else:
+                analysisZones = [analysisZone]
+            for u in self.inserted + self.users:  # the new users that were not inserted have no position
+                if u.timeInterval is not None and u.getLastInstant() == instant:
+                    for zone in analysisZones:
+                        zone.updateUser(u, instant)
         for u in self.inserted:
             for u2 in self.users:
                 if u2 == u.getLeader():
@@ -445,13 +677,15 @@ class World:
                     categoryNum = 2
                 else:
                     categoryNum = None
-                newInteraction = events.Interaction(num=len(self.interactions)+len(self.completedInteractions), roadUser1=u, roadUser2=u2, timeInterval=u.commonTimeInterval(u2), useCurvilinear=True, categoryNum=categoryNum)
-                newInteraction.roadUser1Positions = {}
-                newInteraction.roadUser2Positions = {}
-                self.addInteractions(newInteraction)
+                if self.isInteractionCandidate(u, u2, categoryNum, instant):
+                    newInteraction = events.Interaction(num=len(self.interactions)+self.getNCompletedInteractions(), roadUser1=u, roadUser2=u2, timeInterval=u.commonTimeInterval(u2), useCurvilinear=True, categoryNum=categoryNum)
+                    newInteraction.roadUser1Positions = {}
+                    newInteraction.roadUser2Positions = {}
+                    self.addInteractions(newInteraction)
             self.newUsers.remove(u)
             self.users.append(u)
         for u in self.newlyCompleted:
+            u.getCurrentAlignment().removeUser(u)
             self.users.remove(u)
             u.getCurvilinearVelocities().duplicateLastPosition()
             self.completed.append(u)
@@ -460,19 +694,100 @@ class World:
         # self.exitUsersCumulative.append(len(self.completed))
         # self.completedInteractionsCumulative.append(len(self.completedInteractions))
 
+    def initInteractionCandidates(self, horizon=None):
+        '''only the pairs of users that may interact will have an interaction (see isInteractionCandidate):
+        the users must be on related alignments, ie from which a same alignment can be reached
+        (same alignment chain, leader and follower, approaches to a same intersection)
+        if horizon is not None, the pairs that are neither rear end nor side (categoryNum None)
+        are also discarded if their distance is larger than horizon when the new user is inserted
+        (after prepare)'''
+        reachableAlignments = {}
+        for al in self.alignments:
+            reachableAlignments[al.getIdx()] = set(al2.getIdx() for al2 in self.alignments if al2 == al or self.getNodeDistance(al.getExitNode(), al2.getEntryNode()) < float('inf'))
+        self.relatedAlignments = {}
+        for al in self.alignments:
+            self.relatedAlignments[al.getIdx()] = set(al2.getIdx() for al2 in self.alignments if len(reachableAlignments[al.getIdx()].intersection(reachableAlignments[al2.getIdx()])) > 0)
+        self.interactionHorizon = horizon
+
+    def isInteractionCandidate(self, user, other, categoryNum, instant):
+        '''returns True if an interaction must be created between user, inserted at instant, and other
+        (always if initInteractionCandidates was not called)
+        the pairs with a user that left the network during the step (not updated at instant, whatever the category)
+        are discarded: their interaction would be completed in the same step without any indicator value
+        (see updateInteractions), these empty interactions are thus not counted in the completed interactions
+        the horizon is compared to the euclidean distance, as the distance indicator (see updateInteractions):
+        it is never larger than the distance along the alignments between the positions of the users,
+        so no pair within the horizon along the network is discarded,
+        and it is defined for users on alignments that are not connected (curvilinear distance infinite)'''
+        if self.relatedAlignments is None:
+            return True
+        if other.getLastInstant() < instant:  # other left the network during the step
+            return False
+        if categoryNum is not None:
+            return True
+        if other.getCurrentAlignment().getIdx() not in self.relatedAlignments[user.getCurrentAlignment().getIdx()]:
+            return False
+        return self.interactionHorizon is None or self.distanceAtInstant(user, other, instant, 'euclidean') <= self.interactionHorizon
+
     def addInteractions(self, newInter):
-        if newInter.roadUserNumbers not in [i.roadUserNumbers for i in self.interactions]:
+        key = newInter.getKey()
+        if key not in self.interactions:
             # newInter.num = len(self.interactions)
-            self.interactions.append(newInter)
+            self.interactions[key] = newInter
+
+    def getInteraction(self, roadUserNum1, roadUserNum2):
+        '''returns the interaction between two road users (current or completed), None if it does not exist'''
+        key = events.getInteractionKey(roadUserNum1, roadUserNum2)
+        if key in self.interactions:
+            return self.interactions[key]
+        else:
+            return self.completedInteractionsByKey.get(key, self.completedInteractionSummaries.get(key))
+
+    def getNCompletedUsers(self):
+        return len(self.completed) + len(self.completedUserSummaries)
+
+    def getNCompletedInteractions(self):
+        return len(self.completedInteractions) + len(self.completedInteractionSummaries)
+
+    def initSink(self, sink):
+        '''bounded memory mode: the completed users and interactions will be flushed to sink (see flushCompleted)
+        sink is a callable sink(users, interactions), eg SqliteSink, CompressedFileSink or a user function'''
+        self.sink = sink
+
+    def flushCompleted(self):
+        '''sends the completed users and interactions to the sink
+        and keeps only their summaries (agents.UserSummary and events.InteractionSummary)'''
+        if len(self.completed) > 0 or len(self.completedInteractions) > 0:
+            self.sink(self.completed, self.completedInteractions)
+            for u in self.completed:
+                self.completedUserSummaries.append(agents.UserSummary(u))
+                u.leader = None  # the flushed users may still be the leaders of current users, but their own leaders are not needed anymore
+            for inter in self.completedInteractions:
+                self.completedInteractionSummaries[inter.getKey()] = events.InteractionSummary(inter)
+            self.completed = []
+            self.completedInteractions = []
+            self.completedInteractionsByKey = {}
+
+    def flushRemaining(self):
+        '''sends the users still on the network and the interactions still active at the end of the simulation to the sink
+        (they are kept in users and interactions)'''
+        if len(self.users) > 0 or len(self.interactions) > 0:
+            self.sink(self.users, list(self.interactions.values()))
 
     def updateInteractions(self, instant, computeInteractions):
+        if computeInteractions:
+            self.updatePET()
+            self.updateXYPositions(instant)
         newlyCompleted = []
-        for inter in self.interactions:
+        currentInteractions = []
+        for inter in self.interactions.values():
             if (inter.roadUser1.getLastInstant() < instant) or (inter.roadUser2.getLastInstant() < instant):
                 newlyCompleted.append(inter)
             else:
                 inter.setLastInstant(instant)
-                if computeInteractions:
+                if computeInteractions and self.interactionEngine is not None:
+                    currentInteractions.append(inter)
+                elif computeInteractions:
 
 
                     distanceIndicator = inter.getIndicator(events.Interaction.indicatorNames[2])
@@ -481,13 +796,11 @@ class World:
                         distanceIndicator = indicators.SeverityIndicator(events.Interaction.indicatorNames[2], {instant: None}, mostSevereIsMax=False)
                         inter.addIndicator(distanceIndicator)                        
                     distance = self.distanceAtInstant(inter.roadUser1, inter.roadUser2, instant, 'euclidean')
-                    distanceIndicator.values[instant] = distance
-                    distanceIndicator.getTimeInterval().last = instant
+                    distanceIndicator.setValue(instant, distance)
 
-                    distanceIndicator.getTimeInterval().last = instant
 
                     if inter.categoryNum == 1:  # rearend
-                        distanceIndicator.values[instant] = distance - inter.roadUser2.geometry
+                        distanceIndicator.setValue(instant, distance - inter.roadUser2.geometry)
                         # compute TTC as distance-length/dv
                         if len(inter.roadUser1.getCurvilinearVelocities()) > 0 and len(inter.roadUser2.getCurvilinearVelocities()) > 0:
                             v1 = inter.roadUser1.getCurvilinearVelocityAt(-1)[0]  # compute distance with distanceAtInstant and euclidean distance -> should be kept for rear end TTC computation
@@ -498,8 +811,7 @@ class World:
                                 if ttcIndicator is None:
                                     ttcIndicator = indicators.SeverityIndicator(events.Interaction.indicatorNames[7], {}, mostSevereIsMax=False)
                                     inter.addIndicator(ttcIndicator)
-                                ttcIndicator.values[instant] = ttc
-                                ttcIndicator.getTimeInterval().last = instant
+                                ttcIndicator.setValue(instant, ttc)
 
                                 speedDifferentialIndicator = inter.getIndicator(events.Interaction.indicatorNames[5])
                                 if speedDifferentialIndicator is None:
@@ -508,8 +820,7 @@ class World:
                                 # v1 = inter.roadUser1.getCurvilinearVelocityAt(-1)[0]  # compute distance with distanceAtInstant and euclidean distance -> should be kept for rear end TTC computation
                                 # v2 = inter.roadUser2.getCurvilinearVelocityAt(-1)[0]
                                 if (v1, v2) != (0, 0):
-                                    speedDifferentialIndicator.values[instant] = v1-v2
-                                    speedDifferentialIndicator.getTimeInterval().last = instant
+                                    speedDifferentialIndicator.setValue(instant, v1-v2)
 
 
 
@@ -542,31 +853,48 @@ class World:
                                     if ttcIndicator is None:
                                         ttcIndicator = indicators.SeverityIndicator(events.Interaction.indicatorNames[7], {instant: None}, mostSevereIsMax=False)
                                         inter.addIndicator(ttcIndicator)
-                                    ttcIndicator.values[instant] = ttc
-                                    ttcIndicator.getTimeInterval().last = instant
+                                    ttcIndicator.setValue(instant, ttc)
+
+                    if self.indicatorAggregator is not None:
+                        self.indicatorAggregator.updateInteraction(inter, instant)
+
+        if len(currentInteractions) > 0:
+            self.interactionEngine.updateIndicators(currentInteractions, instant)
+            if self.indicatorAggregator is not None:
+                for inter in currentInteractions:
+                    self.indicatorAggregator.updateInteraction(inter, instant)
 
         for inter in newlyCompleted:
-            self.interactions.remove(inter)
+            key = inter.getKey()
+            if self.indicatorAggregator is not None:
+                self.indicatorAggregator.completeInteraction(inter)
+            del self.interactions[key]
             self.completedInteractions.append(inter)
-
-    def computePET(self, sim):
-        if sim.computeInteractions:
-            users = sorted([u for u in self.completed+self.users if u.getIntersectionExitInstant() is not None], key=lambda u: u.getIntersectionEntryInstant())
-            interactions = [inter for inter in self.completedInteractions+self.interactions if inter.categoryNum == 2]
-            for i in range(1,len(users)):
-                t1 = users[i-1].getIntersectionExitInstant() # premier
-                t2 = users[i].getIntersectionEntryInstant() # dernier
+            self.completedInteractionsByKey[key] = inter
+
+    def updatePET(self):
+        '''computes the PET of the users that crossed an intersection during the current step
+        with the last user that crossed the same intersection before them (by order of intersection entry instant):
+        PET is the time between the exit of the first user and the entry of the second (0 if they overlap)
+        and is added to their interaction if it is a side interaction'''
+        for user, intersection in sorted(self.intersectionCrossings, key=lambda crossing: crossing[0].getIntersectionEntryInstant()):
+            previousUserNum = intersection.getLastUserInNum()
+            if previousUserNum is not None:
+                t1 = intersection.getLastUserInExitInstant()  # premier
+                t2 = user.getIntersectionEntryInstant()  # dernier
                 if t1 > t2:
                     pet = 0
                 else:
                     pet = t2-t1
-                userNumbers = set([users[i-1].getNum(), users[i].getNum()])
-                j = 0
-                while j<len(interactions) and userNumbers != interactions[j].roadUserNumbers:
-                    j += 1
-                if j<len(interactions):
-                    interactions[j].addIndicator(indicators.SeverityIndicator(events.Interaction.indicatorNames[10], {t1: pet}, mostSevereIsMax=False))
-                    interactions.remove(interactions[j])
+                inter = self.getInteraction(previousUserNum, user.getNum())
+                if inter is not None and inter.categoryNum == 2:
+                    inter.addIndicator(indicators.SeverityIndicator(events.Interaction.indicatorNames[10], {t1: pet}, mostSevereIsMax=False))
+                    if self.indicatorAggregator is not None:
+                        if inter.getKey() in self.interactions:
+                            self.indicatorAggregator.addValue(inter, events.Interaction.indicatorNames[10], pet, t1, False)
+                        else:
+                            self.indicatorAggregator.addSummaryValue(inter.categoryNum, events.Interaction.indicatorNames[10], pet)
+            intersection.setLastUserIn(user)
 
     def initNodesToAlignments(self):
         """sets an entry and an exit node to each alignment"""
@@ -606,6 +934,15 @@ class World:
         G.add_weighted_edges_from(edgesProperties)
         self.graph = G
 
+    def initNodeDistances(self):
+        """computes the shortest distances between all pairs of nodes of the graph
+        (the graph does not change during the simulation)"""
+        self.nodeDistances = dict(nx.all_pairs_dijkstra_path_length(self.graph, weight='weight'))
+
+    def getNodeDistance(self, origin, target):
+        """returns the shortest distance from node origin to node target, infinity if target can not be reached"""
+        return self.nodeDistances[origin].get(target, float('inf'))
+
     def distanceAtInstant(self, user1, user2, instant, method):
         """"computes the distance between 2 users"""
         if user1.getFirstInstant() <= instant and user2.getFirstInstant() <= instant:
@@ -616,49 +953,50 @@ class World:
                     if user1AlignmentIdx == user2AlignmentIdx:
                         return abs(s1 - s2) - user1.orderUsersByPositionAtInstant(user2, instant)[0].geometry
                     else:
-                        user1UpstreamDistance = user1.getCurvilinearPositionAtInstant(instant)[0]
-                        user1DownstreamDistance = self.alignments[user1.getCurvilinearPositionAtInstant(instant)[2]].getTotalDistance() - user1UpstreamDistance
-                        user2UpstreamDistance = user2.getCurvilinearPositionAtInstant(instant)[0]
-                        user2DownstreamDistance = self.alignments[user2.getCurvilinearPositionAtInstant(instant)[2]].getTotalDistance() - user2UpstreamDistance
-
-                        G = self.graph
-
-                        G.add_node('user1')
-                        G.add_node('user2')
-
-                        user1Origin = self.alignments[user1AlignmentIdx].entryNode
+                        # user1 leaves its alignment at its exit node, user2 is reached from the entry or exit node of its alignment
+                        user1DownstreamDistance = self.alignments[user1AlignmentIdx].getTotalDistance() - s1
+                        user2DownstreamDistance = self.alignments[user2AlignmentIdx].getTotalDistance() - s2
                         user1Target = self.alignments[user1AlignmentIdx].exitNode
                         user2Origin = self.alignments[user2AlignmentIdx].entryNode
                         user2Target = self.alignments[user2AlignmentIdx].exitNode
-
-                        G.add_weighted_edges_from([(user1Origin, 'user1', user1UpstreamDistance)])
-                        G.add_weighted_edges_from([('user1', user1Target, user1DownstreamDistance)])
-                        G.add_path([user1Target, 'user1'], weight=user1DownstreamDistance)
-
-                        G.add_weighted_edges_from([(user2Origin, 'user2', user2UpstreamDistance)])
-                        G.add_weighted_edges_from([('user2', user2Target, user2DownstreamDistance)])
-                        G.add_path([user2Target, 'user2'], weight=user2DownstreamDistance)
-
-                        distance = nx.shortest_path_length(G, source='user1', target='user2', weight='weight')
+                        distance = user1DownstreamDistance + min(self.getNodeDistance(user1Target, user2Origin) + s2, self.getNodeDistance(user1Target, user2Target) + user2DownstreamDistance)
                         # if situation == 'CF':
                         #     leader = user1.orderUsersByPositionAtInstant(user2, instant)[0]
                         #     distance -= leader.geometry
-
-                        G.remove_node('user1')
-                        G.remove_node('user2')
                         return distance
 
             elif method == 'euclidean':
                 #user1, user2 = user1.orderUsersByPositionAtInstant(user2, instant)
-                s1 = user1.getCurvilinearPositionAtInstant(instant)
-                s2 = user2.getCurvilinearPositionAtInstant(instant)
-                p1 = moving.getXYfromSY(s1[0], s1[1], s1[2], [al.points for al in self.alignments])
-                p2 = moving.getXYfromSY(s2[0], s2[1], s2[2], [al.points for al in self.alignments])
-                distance = (p1 - p2).norm2()
-                return distance
+                x1, y1 = self.getXYAtInstant(user1, instant)
+                x2, y2 = self.getXYAtInstant(user2, instant)
+                return sqrt((x1-x2)**2 + (y1-y2)**2)
         else:
             print('user do not coexist, therefore can not compute distance')
 
+    def updateXYPositions(self, instant):
+        '''computes the coordinates of all the current users at instant at once
+        and stores them in the cache of the coordinates (see getXYAtInstant)'''
+        users = [u for u in self.users if u.getLastInstant() == instant]
+        if len(users) > 0:
+            s = np.empty(len(users))
+            y = np.empty(len(users))
+            alignmentIndices = np.empty(len(users), dtype=int)
+            for i, u in enumerate(users):
+                s[i], y[i], alignmentIndices[i] = u.curvilinearPositions[instant-u.getFirstInstant()]
+            for alignmentIdx in np.unique(alignmentIndices):
+                onAlignment = np.flatnonzero(alignmentIndices == alignmentIdx)
+                xy = self.alignments[alignmentIdx].getXYfromSY(s[onAlignment], y[onAlignment]).tolist()
+                for i, p in zip(onAlignment, xy):
+                    self.xyPositions[(users[i].getNum(), instant)] = p
+
+    def getXYAtInstant(self, user, instant):
+        '''returns the coordinates of user at instant (cached)'''
+        key = (user.getNum(), instant)
+        if key not in self.xyPositions:
+            s, y, alignmentIdx = user.getCurvilinearPositionAtInstant(instant)
+            self.xyPositions[key] = self.alignments[alignmentIdx].getXYfromSY(s, y).tolist()
+        return self.xyPositions[key]
+
     def travelledAlignments(self, user, instant):
         """"returns a list of the alignments that user travelled on"""
         if instant is not None:
@@ -680,16 +1018,17 @@ class World:
             if len(user.curvilinearVelocities) > 0:
                 user.getCurvilinearVelocities().duplicateLastPosition()
 
-    def prepare(self, timeStep, duration):
+    def prepare(self, timeStep, duration, seed=None):
         '''Prepares the world before simulation
         - verify alignments and controlDevices are stored in order
-        - init user inputs, links to alignments
+        - init user inputs (with streams of variates seeded from seed), links to alignments
         - links the alignments using connectedAlignments
         - resets and links controlDevices to their alignments
         - initializes lists of users
         - creates intersections objects and links them to the corresponding alignments
         - sets probabilities of travel for connected alignments
-        - initializes the graph
+        - initializes the graph and the distances between its nodes
+        - computes the predicted crossing points for all pairs of alignments
 
         note: duration and timeStep are in usual time units (eg seconds)'''
 
@@ -713,12 +1052,13 @@ class World:
             for al in self.alignments:
                 if al.idx == ui.alignmentIdx:
                     ui.alignment = al
-            ui.initDistributions(timeStep)
+            ui.initDistributions(timeStep, seed)
             ui.generateTimeArrival()
 
         # compute cumulative distances for each alignment :
         for al in self.alignments:
             al.points.computeCumulativeDistances()
+            al.initSegments()
 
         # resetting all control devices to default values
         if self.controlDevices is not None:
@@ -736,6 +1076,7 @@ class World:
             al.transversalAlignments = None
             al.currentUsers = {}
             al.firstUser = None
+            al.initOccupancy()
             al.controlDevice = None
 
             if al.getConnectedAlignmentIndices() is not None:
@@ -767,7 +1108,7 @@ class World:
                         intersection.idx = len(self.intersections)
                         self.intersections.append(intersection)
 
-                al.initConnectedAlignmentDistribution()
+                al.initConnectedAlignmentDistribution(seed)
 
         if self.controlDevices is not None:
             for cd in self.controlDevices:
@@ -793,21 +1134,50 @@ class World:
             for exitAl in intersection.exitAlignments:
                 exitAl.entryIntersection = intersection
 
-        # linking self to its graph
+        # linking self to its graph and computing the distances between its nodes
         self.initGraph()
+        self.initNodeDistances()
+
+        # predicted crossing points for all pairs of alignments
+        self.initCrossingCatalogue()
 
         # initializing the lists of users
         self.newUsers = []
         self.users = []
         self.completed = []
-
-        # initializing interactions list
-        self.interactions = []
+        self.intersectionCrossings = []
+        self.stepEngine = None
+        self.interactionEngine = None
+        self.eventDriven = False
+        self.analysisZone = None
+
+        # state of the simulation loop (see simulation.Simulation.resume)
+        self.instant = 0
+        self.userNum = 0
+        self.nextInstant = 0  # first instant at which the users must be updated (event driven stepping)
+        self.indicatorAggregator = None
+        self.relatedAlignments = None
+        self.interactionHorizon = None
+        self.xyPositions = {}
+
+        # initializing interactions: current interactions are indexed by the pair of road user numbers
+        self.interactions = {}
         self.completedInteractions = []
+        self.completedInteractionsByKey = {}
+
+        # bounded memory mode: summaries of the users and interactions flushed to the sink
+        self.sink = None
+        self.completedUserSummaries = []
+        self.completedInteractionSummaries = {}
 
         self.exitUsersCumulative = []
         self.completedInteractionsCumulative = []
 
+    def initIndicatorAggregator(self, **kwargs):
+        '''creates the online aggregator of the indicators of the interactions (see analysis.IndicatorAggregator)
+        (after prepare)'''
+        self.indicatorAggregator = analysis.IndicatorAggregator(**kwargs)
+
     def getIntersectionXYcoords(self):
         """returns intersection XY coordinates"""
         for al in self.alignments:
@@ -837,24 +1207,11 @@ class World:
 
     def distanceToCrossingAtInstant(self, user, incomingUser, instant):
         """"returns distance to intersection"""
-        G = self.graph
-
-        G.add_node('incomingUser')
         cp = incomingUser.getCurvilinearPositionAtInstant(instant)
-
-        origin = self.alignments[cp[2]].getEntryNode()
         target = self.alignments[cp[2]].getExitNode()
-
-        upstreamDistance = incomingUser.getCurvilinearPositionAtInstant(instant)[0]
-        downstreamDistance = self.alignments[cp[2]].getTotalDistance() - upstreamDistance
-
-        G.add_weighted_edges_from([(origin, 'incomingUser', upstreamDistance)])
-        G.add_weighted_edges_from([('incomingUser', target, downstreamDistance)])
+        downstreamDistance = self.alignments[cp[2]].getTotalDistance() - cp[0]
         center = self.getNodesFromCrossingPoints(user, incomingUser, instant)[0]  # a modifier selon les un classement sur les probabilités
-        distance = nx.shortest_path_length(G, source='incomingUser', target=center, weight='weight')
-        G.remove_node('incomingUser')
-
-        return distance
+        return downstreamDistance + self.getNodeDistance(target, center)
 
     def estimateGap(self, user):
         """returns an estimate of the gap at X intersection, based on the speed of the incoming vehicle,
@@ -877,13 +1234,14 @@ class World:
         return gap
 
     def travelledAlignmentsDistanceAtInstant(self, user, instant):
-        """returns travelled distance of user at instant
-        0 if the user did not change alignment
-        length of travelled alignments otherwise """
-        s = 0
-        for al in self.travelledAlignments(user, instant):
-            s += al.getTotalDistance()
-        return s
+        """returns the total length of the alignments travelled by user before instant
+        (0 if instant is not after its first instant) """
+        if instant is None:
+            return user.getTotalDistance()
+        elif instant <= user.getFirstInstant():
+            return 0
+        else:
+            return user.getDistanceToAlignmentEnd(user.getCurvilinearPositionAtInstant(min(instant, user.getLastInstant() + 1) - 1)[2])
 
     def isClearingTimeAcceptable(self, user, timeStep):
         """determines if intersection clearing time for user is acceptable"""
@@ -935,10 +1293,17 @@ class World:
             return {al: al.firstUser for al in currentUserAlignment.transversalAlignments}
 
     def scan(self, transversalAlignments, instant, withCompleted=False):
-        """ returns users on transversal alignment ordered by ascending curvilinear position at instant on alignment"""
+        """ returns users on transversal alignment ordered by ascending curvilinear position at instant on alignment
+        (from the first users of the transversal alignments if instant is the last update of their occupancy)"""
         potentialTransversalUsers = []
         if transversalAlignments is not None:
-            if withCompleted:
+            if all(al.occupancyInstant is not None and al.occupancyInstant == instant for al in transversalAlignments):
+                firstUsers = [al.occupancy[-1] for al in transversalAlignments if len(al.occupancy) > 0]
+                if len(firstUsers) > 0:
+                    return max(firstUsers, key=lambda u: u.curvilinearPositions.getSCoordAt(-1))
+                else:
+                    return None
+            elif withCompleted:
                 for u in self.users + self.completed:
                     if u.timeInterval is not None:
                         if instant in u.timeInterval:
@@ -958,41 +1323,52 @@ class World:
         else:
             return None
 
-    def getPredictedCrossingPoints(self, user, other, instant):
-        """returns predicted crossing points for a pair of users"""
-        cp1 = user.getCurvilinearPositionAtInstant(instant)
-        cp2 = other.getCurvilinearPositionAtInstant(instant)
-
-        userPredictedTrajectories = self.alignments[cp1[2]].getAllPossibleAlignmentIntersectionSequences()
-        otherPredictedTrajectories = self.alignments[cp2[2]].getAllPossibleAlignmentIntersectionSequences()
+    def initCrossingCatalogue(self):
+        """computes, for each pair of alignments, the predicted crossing points of users on these alignments
+        (items common to their possible alignment-intersection sequences),
+        the nodes and the curvilinear positions of the corresponding intersections
+        (they only depend on the network)"""
+        self.crossingPoints = {}
+        self.crossingNodes = {}
+        self.crossingCurvilinearPositions = {}
+        sequences = {al.idx: al.getAllPossibleAlignmentIntersectionSequences() for al in self.alignments}
+        for al1 in self.alignments:
+            for al2 in self.alignments:
+                crossingPoints = []
+                for userTrajectory in sequences[al1.idx]:
+                    for otherTrajectory in sequences[al2.idx]:
+                        _temp = [item for item in userTrajectory if item in otherTrajectory and item is not None]
+                        crossingPoints.extend(_temp)
+                nodes = []
+                curvilinearPositions = []
+                for intersection in crossingPoints:
+                    if isinstance(intersection, Intersection):  # common alignments are not crossing points
+                        nodes.extend([entryAlignment.exitNode for entryAlignment in intersection.entryAlignments])
+                        curvilinearPositions.extend([[entryAlignment.getTotalDistance(), 0, entryAlignment.idx] for entryAlignment in intersection.entryAlignments])
+                self.crossingPoints[(al1.idx, al2.idx)] = crossingPoints
+                self.crossingNodes[(al1.idx, al2.idx)] = nodes
+                self.crossingCurvilinearPositions[(al1.idx, al2.idx)] = curvilinearPositions
 
-        crossingPoints = []
-        for userTrajectory in userPredictedTrajectories:
-            for otherTrajectory in otherPredictedTrajectories:
-                _temp = [item for item in userTrajectory if item in otherTrajectory and item is not None]
-                crossingPoints.extend(_temp)
+    @staticmethod
+    def getAlignmentPairAtInstant(user, other, instant):
+        """returns the pair of the alignment indices of the users at instant"""
+        return user.getCurvilinearPositionAtInstant(instant)[2], other.getCurvilinearPositionAtInstant(instant)[2]
 
-        return crossingPoints
+    def getPredictedCrossingPoints(self, user, other, instant):
+        """returns predicted crossing points for a pair of users"""
+        return self.crossingPoints[self.getAlignmentPairAtInstant(user, other, instant)]
 
     def getNodesFromCrossingPoints(self, user, other, instant):
-        """returns nodes of corresponding crossing points"""
-        crossingPoints = self.getPredictedCrossingPoints(user, other, instant)
-        nodes = []
-        if crossingPoints != set():
-            for intersection in crossingPoints:
-                _temp = [entryAlignment.exitNode for entryAlignment in intersection.entryAlignments]
-                nodes.extend(_temp)
+        """returns nodes of corresponding crossing points, None if there is none"""
+        nodes = self.crossingNodes[self.getAlignmentPairAtInstant(user, other, instant)]
+        if len(nodes) > 0:
             return nodes
         else:
             return None
 
     def getCrossingPointCurvilinearPosition(self, user, other, instant):
-        crossingPoints = self.getPredictedCrossingPoints(user, other, instant)
-        if crossingPoints != set():
-            curvilinearPositions = []
-            for intersection in crossingPoints:
-                curvilinearPositions.extend([[entryAlignment.getTotalDistance(), 0, entryAlignment.idx] for entryAlignment in intersection.entryAlignments])
-
+        curvilinearPositions = self.crossingCurvilinearPositions[self.getAlignmentPairAtInstant(user, other, instant)]
+        if len(curvilinearPositions) > 0:
             return curvilinearPositions
         else:
             return None
@@ -1025,32 +1401,37 @@ class World:
         elif len(userSet1) == 0 or len(userSet2) == 0:
             return None, None
 
-    def saveTrajectoriesToDB(self, dbName, seed, analysisId):
-        self.saveCurvilinearTrajectoriesToSqlite(dbName, seed, analysisId)
+    def saveTrajectoriesToDB(self, dbName, seed, analysisId, journalMode=None, synchronous=None):
+        self.saveCurvilinearTrajectoriesToSqlite(dbName, seed, analysisId, journalMode, synchronous)
 
-    def saveObjects(self, dbName, seed, analysisId):
+    def saveObjects(self, dbName, seed, analysisId, journalMode=None, synchronous=None):
+        with sqlite3.connect(dbName) as connection:
+            toolkit.setSqlitePragmas(connection, journalMode, synchronous)
+            saveObjectsToTable(connection, [obj for obj in self.users + self.completed if obj.timeInterval is not None], seed, analysisId)
+        connection.close()
+
+    def saveToSqlite(self, dbName, seed, analysisId, journalMode=None, synchronous=None):
+        '''saves the objects and their curvilinear trajectories in a single transaction
+        (the tables are created if necessary)'''
+        createNewellMovingObjectsTable(dbName)
+        objects = [obj for obj in self.users + self.completed if obj.timeInterval is not None]
         with sqlite3.connect(dbName) as connection:
-            cursor = connection.cursor()
-            objectQuery = "INSERT INTO objects VALUES (?,?,?,?,?,?,?,?,?,?)"
-            for obj in self.users + self.completed:
-                if obj.timeInterval is not None:
-                    cursor.execute(objectQuery, (obj.getNum(), seed, analysisId, obj.getUserType(), obj.tau, obj.d, obj.desiredSpeed, obj.geometry, obj.getFirstInstant(), obj.getLastInstant()))
-                    connection.commit()
+            toolkit.setSqlitePragmas(connection, journalMode, synchronous)
+            saveObjectsToTable(connection, objects, seed, analysisId, commit=False)
+            saveTrajectoriesToTable(connection, objects, 'curvilinear', seed, analysisId, commit=False)
+        connection.close()
 
     def updateFirstUsers(self):
+        '''updates the order of the users on each alignment at the current instant and the first users'''
         for al in self.alignments:
-            if al.firstUser is None or al.firstUser.getCurvilinearPositionAt(-1)[2] != al.getIdx():
-                s = -1
-                for u in self.users:
-                    p = u.getCurvilinearPositionAt(-1)
-                    if p[2] == al.getIdx():
-                        if p[0] > s:
-                            s = p[0]
-                            al.firstUser = u
+            al.updateOccupancy(self.instant)
 
     def computeMeanVelocities(self, timeStep):
-        self.v1 = {0: np.mean([np.mean(u.curvilinearVelocities.positions[0]) / timeStep for u in self.completed if u.getInitialAlignment().idx == 0]), 2: np.mean([np.mean(u.curvilinearVelocities.positions[0]) / timeStep for u in self.completed if u.getInitialAlignment().idx == 2])}
-        self.v2 = {0: np.mean([np.mean(u.getTotalDistance() / (len(u.curvilinearPositions) * timeStep)) for u in self.completed if u.getInitialAlignment().idx == 0]), 2: np.mean([np.mean(u.getTotalDistance() / (len(u.curvilinearPositions) * timeStep)) for u in self.completed if u.getInitialAlignment().idx == 2])}
+        '''computes the mean speeds of the completed users per initial alignment (0 and 2),
+        v1 from their speeds and v2 from their travel times (also on the flushed users summaries)'''
+        summaries = self.completedUserSummaries + [agents.UserSummary(u) for u in self.completed]
+        self.v1 = {idx: np.mean([s.meanSpeed / timeStep for s in summaries if s.getInitialAlignmentIdx() == idx]) for idx in [0, 2]}
+        self.v2 = {idx: np.mean([np.mean(s.totalDistance / (s.nPositions * timeStep)) for s in summaries if s.getInitialAlignmentIdx() == idx]) for idx in [0, 2]}
 
 class UserInput:
     def __init__(self, idx, alignmentIdx, distributions):
@@ -1065,7 +1446,7 @@ class UserInput:
     def load(filename):
         return toolkit.loadYaml(filename)
 
-    def initDistributions(self, timeStep):
+    def initDistributions(self, timeStep, seed=None):
         self.headwayDistribution = self.distributions['headway'].getDistribution(1. / timeStep)
         self.timeArrival = 0.
         self.lengthDistribution = self.distributions['length'].getDistribution()
@@ -1074,6 +1455,26 @@ class UserInput:
         self.dDistribution = self.distributions['dn'].getDistribution()
         self.gapDistribution = self.distributions['criticalGap'].getDistribution(1. / timeStep)
         # self.amberProbabilityDistribution = self.distributions['amberProbability'].getDistribution()
+        self.initVariateStreams(seed)
+
+    def initVariateStreams(self, seed=None):
+        """initializes the streams of variates of the user input: each variable is drawn in blocks
+        from its own generator, seeded from seed and the user input and variable indices
+        if seed is None, it is drawn from the global numpy generator"""
+        if seed is None:
+            seed = np.random.randint(np.iinfo(np.int32).max)
+        self.variateStreams = {}
+        for i, (name, distribution) in enumerate([('headway', self.headwayDistribution),
+                                                  ('length', self.lengthDistribution),
+                                                  ('speed', self.speedDistribution),
+                                                  ('tau', self.tauDistribution),
+                                                  ('dn', self.dDistribution),
+                                                  ('criticalGap', self.gapDistribution)]):
+            self.variateStreams[name] = VariateStream(distribution, np.random.default_rng([seed, self.idx, i]))
+
+    def drawVariate(self, name):
+        """returns the next variate of variable name (eg 'headway' or 'speed')"""
+        return self.variateStreams[name].rvs()
 
     # def generateHeadways(self, duration):
     #     """ generates a set a headways"""
@@ -1081,7 +1482,7 @@ class UserInput:
     #     self.cumulatedHeadways = list(itertools.accumulate(self.headways))
     
     def generateTimeArrival(self):
-        self.timeArrival += self.headwayDistribution.rvs()
+        self.timeArrival += self.drawVariate('headway')
 
     def getTimeArrival(self):
         return self.timeArrival
@@ -1094,12 +1495,12 @@ class UserInput:
         """generates a MovingObject on the VehicleInput alignment"""
 
         obj = agents.NewellMovingObject(userNum,
-                                        geometry=self.lengthDistribution.rvs(),
+                                        geometry=self.drawVariate('length'),
                                         initCurvilinear=True,
-                                        desiredSpeed=self.speedDistribution.rvs(),
-                                        tau=self.tauDistribution.rvs(),
-                                        d=self.dDistribution.rvs(),
-                                        criticalGap=self.gapDistribution.rvs(),
+                                        desiredSpeed=self.drawVariate('speed'),
+                                        tau=self.drawVariate('tau'),
+                                        d=self.drawVariate('dn'),
+                                        criticalGap=self.drawVariate('criticalGap'),
                                         # kj=120 veh/km
                                         initialCumulatedHeadway=initialCumulatedHeadway,
                                         initialAlignment=self.alignment)
@@ -1107,11 +1508,11 @@ class UserInput:
         obj.interactions = None
         obj.intersectionEntryInstant = None
         obj.intersectionExitInstant = None
-        obj.timeIntervalInAnalysisZone = moving.TimeInterval()
-        # obj.timeIntervalInAnalysisZone.first, obj.timeIntervalInAnalysisZone.last = None, None
+        obj.timeIntervalsInAnalysisZone = {}  # analysis zone area -> time interval of the first passage in the zone
         if self.lastGeneratedUser is not None:
             obj.leader = self.lastGeneratedUser
             obj.updateD(safetyDistance)
+            obj.leader.setMinDistanceHistoryLength(obj.tau)
             # print(obj.timeInterval)
         self.lastGeneratedUser = obj
         return obj
@@ -1123,6 +1524,33 @@ class UserInput:
         return self.idx
 
 
+class VariateStream(object):
+    """Stream of variates of a distribution (scipy.stats frozen distribution,
+    empirical or constant distribution from trafficintelligence.utils)
+    drawn in blocks of blockSize values with its own generator and refilled when exhausted"""
+    def __init__(self, distribution, generator, blockSize=256):
+        self.distribution = distribution
+        self.generator = generator
+        self.blockSize = blockSize
+        self.block = []
+        self.i = 0
+
+    def drawBlock(self):
+        if isinstance(self.distribution, utils.ConstantDistribution):
+            return [self.distribution.value] * self.blockSize
+        elif isinstance(self.distribution, utils.EmpiricalContinuousDistribution):  # inverse of the piecewise linear cdf
+            return np.interp(self.generator.random(self.blockSize), self.distribution.probabilities, self.distribution.values).tolist()
+        else:
+            return self.distribution.rvs(size=self.blockSize, random_state=self.generator).tolist()
+
+    def rvs(self):
+        if self.i >= len(self.block):
+            self.block = self.drawBlock()
+            self.i = 0
+        self.i += 1
+        return self.block[self.i - 1]
+
+
 class CarGeometry:
     def __init__(self, length=None, width=None, polygon=None):
         self.width = width
@@ -1219,6 +1647,20 @@ class Intersection:
     def __init__(self, entryAlignments=None, exitAlignments=None):
         self.entryAlignments = entryAlignments
         self.exitAlignments = exitAlignments
+        # last user that entered the intersection, for PET computation: only its num and exit instant are kept
+        # (the user may have been flushed to the sink since)
+        self.lastUserInNum = None
+        self.lastUserInExitInstant = None
+
+    def getLastUserInNum(self):
+        return self.lastUserInNum
+
+    def getLastUserInExitInstant(self):
+        return self.lastUserInExitInstant
+
+    def setLastUserIn(self, user):
+        self.lastUserInNum = user.getNum()
+        self.lastUserInExitInstant = user.getIntersectionExitInstant()
 
     def setEntryAlignments(self, entryAlignments):
         self.entryAlignments = entryAlignments
@@ -1254,22 +1696,100 @@ def createNewellMovingObjectsTable(db):
     cursor.execute("CREATE TABLE IF NOT EXISTS objects (object_id INTEGER, seed INTEGER, analysis_id INTEGER, road_user_type INTEGER, tau REAL, d REAL, desired_speed REAL, geometry REAL, first_instant, last_instant, PRIMARY KEY(object_id, seed, analysis_id))")
     createCurvilinearTrajectoryTable(cursor)
     connection.commit()
+    connection.close()
 
 
-def saveTrajectoriesToTable(connection, objects, trajectoryType, seed, analysisId):
-    'Saves trajectories in table tableName'
-    cursor = connection.cursor()
+def saveObjectsToTable(connection, objects, seed, analysisId, commit=True):
+    'Saves objects in table objects, with a single executemany'
+    objectQuery = "INSERT INTO objects VALUES (?,?,?,?,?,?,?,?,?,?)"
+    connection.executemany(objectQuery, ((obj.getNum(), seed, analysisId, obj.getUserType(), obj.tau, obj.d, obj.desiredSpeed, obj.geometry, obj.getFirstInstant(), obj.getLastInstant()) for obj in objects))
+    if commit:
+        connection.commit()
+
+
+def getCurvilinearTrajectoryRows(obj, seed, analysisId):
+    'Returns the rows of table curvilinear_positions for the trajectory of obj'
+    trajectory = obj.getCurvilinearPositions()
+    firstInstant = obj.getFirstInstant()
+    n = len(trajectory)
+    return zip(itertools.repeat(obj.getNum(), n), itertools.repeat(seed, n), itertools.repeat(analysisId, n), range(firstInstant, firstInstant + n),
+               np.asarray(trajectory.positions[0], dtype=float).tolist(), np.asarray(trajectory.positions[1], dtype=float).tolist(), list(trajectory.lanes))
+
+
+def saveTrajectoriesToTable(connection, objects, trajectoryType, seed, analysisId, commit=True):
+    'Saves trajectories in table tableName, with a single executemany'
     if (trajectoryType == 'curvilinear'):
         curvilinearQuery = "INSERT INTO curvilinear_positions VALUES (?,?,?,?,?,?,?)"
-        for obj in objects:
-            num = obj.getNum()
-            frameNum = obj.getFirstInstant()
-            for p in obj.getCurvilinearPositions():
-                cursor.execute(curvilinearQuery, (num, seed, analysisId, frameNum, p[0], p[1], p[2]))
-                frameNum += 1
+        connection.executemany(curvilinearQuery, itertools.chain.from_iterable(getCurvilinearTrajectoryRows(obj, seed, analysisId) for obj in objects))
     else:
         print('Unknown trajectory type {}'.format(trajectoryType))
-    connection.commit()
+    if commit:
+        connection.commit()
+
+
+class SqliteSink(object):
+    '''Writes the completed users (objects and curvilinear trajectories) and interactions (with their indicators)
+    in a sqlite database as they are flushed by the world in bounded memory mode (see Simulation.run)
+    each flush is a single transaction'''
+    def __init__(self, dbName, seed, analysisId, journalMode=None, synchronous=None):
+        createNewellMovingObjectsTable(dbName)
+        self.seed = seed
+        self.analysisId = analysisId
+        self.analysis = analysis.Analysis(analysisId, None, seed)
+        self.connection = sqlite3.connect(dbName)
+        toolkit.setSqlitePragmas(self.connection, journalMode, synchronous)
+        cursor = self.connection.cursor()
+        self.analysis.createInteractionTable(cursor)
+        self.analysis.createIndicatorTable(cursor)
+        self.connection.commit()
+
+    def __call__(self, users, interactions):
+        objects = [u for u in users if u.timeInterval is not None]
+        saveObjectsToTable(self.connection, objects, self.seed, self.analysisId, commit=False)
+        saveTrajectoriesToTable(self.connection, objects, 'curvilinear', self.seed, self.analysisId, commit=False)
+        self.connection.executemany(self.analysis.interactionQuery, (self.analysis.getInteractionRow(inter) for inter in interactions))
+        self.connection.executemany(self.analysis.indicatorQuery, itertools.chain.from_iterable(self.analysis.getIndicatorRows(inter.getNum(), indicator) for inter in interactions for indicator in inter.indicators.values()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class CompressedFileSink(object):
+    '''Writes the completed users and interactions in a gzip compressed file as they are flushed by the world
+    in bounded memory mode (see Simulation.run)
+    each flush is pickled as a dict of lists of rows, with the same columns as the sqlite tables
+    (objects, curvilinear_positions, interactions and indicators), see load'''
+    def __init__(self, filename, seed, analysisId, compressLevel=6):
+        self.seed = seed
+        self.analysisId = analysisId
+        self.analysis = analysis.Analysis(analysisId, None, seed)
+        self.file = gzip.open(filename, 'wb', compressLevel)
+
+    def __call__(self, users, interactions):
+        objects = [u for u in users if u.timeInterval is not None]
+        rows = {'objects': [(obj.getNum(), self.seed, self.analysisId, obj.getUserType(), obj.tau, obj.d, obj.desiredSpeed, obj.geometry, obj.getFirstInstant(), obj.getLastInstant()) for obj in objects],
+                'curvilinear_positions': list(itertools.chain.from_iterable(getCurvilinearTrajectoryRows(obj, self.seed, self.analysisId) for obj in objects)),
+                'interactions': [self.analysis.getInteractionRow(inter) for inter in interactions],
+                'indicators': list(itertools.chain.from_iterable(self.analysis.getIndicatorRows(inter.getNum(), indicator) for inter in interactions for indicator in inter.indicators.values()))}
+        pickle.dump(rows, self.file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(filename):
+        '''returns the rows of all the flushes, as a dict of lists of rows'''
+        rows = {'objects': [], 'curvilinear_positions': [], 'interactions': [], 'indicators': []}
+        with gzip.open(filename, 'rb') as f:
+            while True:
+                try:
+                    flushRows = pickle.load(f)
+                except EOFError:
+                    break
+                for tableName in rows:
+                    rows[tableName].extend(flushRows[tableName])
+        return rows
 
 
 if __name__ == "__main__":
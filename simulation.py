@@ -1,6 +1,11 @@
+import copy
+import pickle
+from multiprocessing import Pool
+
 import numpy as np
 
 import analysis as an
+import network
 import toolkit
 
 
@@ -13,7 +18,7 @@ class Simulation(object):
         'N/A'
     ]
 
-    def __init__(self, duration, minNCompletedUsers, timeStep, seed, verbose, dbName=None, computeInteractions=False):
+    def __init__(self, duration, minNCompletedUsers, timeStep, seed, verbose, dbName=None, computeInteractions=False, useStepEngine=False, aggregateIndicators=False, freeCompletedIndicators=False, filterInteractions=False, interactionHorizon=None, useInteractionEngine=False, eventDriven=False):
         self.duration = duration
         self.minNCompletedUsers = minNCompletedUsers
         self.timeStep = timeStep
@@ -21,6 +26,13 @@ class Simulation(object):
         self.verbose = verbose
         self.dbName = dbName
         self.computeInteractions = computeInteractions
+        self.useStepEngine = useStepEngine  # vectorised update of the users, see agents.NewellStepEngine
+        self.aggregateIndicators = aggregateIndicators  # online summaries of the indicators, see analysis.IndicatorAggregator
+        self.freeCompletedIndicators = freeCompletedIndicators
+        self.filterInteractions = filterInteractions  # interactions only between users that may interact, see World.initInteractionCandidates
+        self.interactionHorizon = interactionHorizon
+        self.useInteractionEngine = useInteractionEngine  # batched computation of the indicators, see events.InteractionIndicatorEngine
+        self.eventDriven = eventDriven  # skips the updates of the waiting new users and the instants when the network is empty, see World.initEventDrivenStepping
 
     def save(self, filename):
         toolkit.saveYaml(filename, self)
@@ -29,32 +41,137 @@ class Simulation(object):
     def load(filename):
         return toolkit.loadYaml(filename)
 
-    def run(self, world, surface=None):
+    def getSeeds(self):
+        '''returns the seeds of the replications: seed, seed+increment, ... (rep values)'''
+        return [self.seed+i*self.increment for i in range(self.rep)]
+
+    def runReplications(self, worldFilename, surface=None, processResult=None, nProcesses=None):
+        '''runs one replication per seed of getSeeds() in a pool of nProcesses processes
+        (all available cores if None, serial if 1)
+
+        each replication loads its own world from worldFilename and is seeded as in run,
+        so the results are identical to a serial loop over the seeds
+        processResult(world, sim) is applied to each world in its process
+        (it must be a module level function to be sent to the processes)
+        returns the list of results (the worlds if processResult is None) in seed order'''
+        tasks = [(self, worldFilename, seed, surface, processResult) for seed in self.getSeeds()]
+        if nProcesses == 1:
+            return [runReplication(task) for task in tasks]
+        else:
+            with Pool(nProcesses) as pool:
+                return pool.map(runReplication, tasks)
+
+    def run(self, world, surface=None, sink=None):
+        '''runs the simulation in world
+        the passages of the users through the analysis zones of area surface (number or list) are recorded
+        in their timeIntervalsInAnalysisZone (see analysis.AnalysisZone.updateUser)
+        bounded memory mode if sink is not None: the completed users and interactions are flushed to sink at each step
+        and only their summaries are kept (see World.flushCompleted),
+        the users still on the network and the interactions still active are flushed at the end (see World.flushRemaining)
+        PETs are computed at each step, when the users enter the intersections (see World.updatePET)
+        if eventDriven, the instants when the network is empty are skipped until the next insertion of a user
+        (the control devices are updated and the users generated as usual)'''
+        self.start(world, surface, sink)
+        self.resume(world)
+
+    def start(self, world, surface=None, sink=None):
+        '''prepares world for the simulation (see run), that is then run by resume'''
         np.random.seed(self.seed)
 
         # preparing simulation
-        world.prepare(self.timeStep, self.duration)
-        if surface is not None:
-            analysisZone = an.AnalysisZone(world.intersections[0], surface)
+        world.prepare(self.timeStep, self.duration, self.seed)
+        if sink is not None:
+            world.initSink(sink)
+        if getattr(self, 'useStepEngine', False):
+            world.initStepEngine()
+        if getattr(self, 'useInteractionEngine', False):
+            world.initInteractionEngine()
+        if getattr(self, 'eventDriven', False):
+            world.initEventDrivenStepping()
+        if getattr(self, 'aggregateIndicators', False):
+            world.initIndicatorAggregator(freeCompletedIndicators=getattr(self, 'freeCompletedIndicators', False))
+        if getattr(self, 'filterInteractions', False):
+            world.initInteractionCandidates(getattr(self, 'interactionHorizon', None))
+        if surface is None:
+            world.analysisZone = None
+        elif isinstance(surface, (list, tuple)):  # several analysis zones at once
+            world.analysisZone = [an.AnalysisZone(world.intersections[0], area) for area in surface]
         else:
-            analysisZone = None
-        
-        # main loop
-        userNum = 0
-        instant = 0
+            world.analysisZone = an.AnalysisZone(world.intersections[0], surface)
+
+    def isRunning(self, world):
+        return world.instant*self.timeStep < self.duration or world.getNCompletedUsers() < self.minNCompletedUsers
 
-        while instant*self.timeStep < self.duration or len(world.completed) < self.minNCompletedUsers:
+    def resume(self, world, lastInstant=None):
+        '''runs the simulation in world from its current instant (after start or loadCheckpoint)
+        until the end of the simulation, or until lastInstant (included) if not None:
+        the simulation may then be saved (see saveCheckpoint) and resumed
+        returns True if the simulation is finished'''
+        while self.isRunning(world):
+            if lastInstant is not None and world.instant > lastInstant:
+                return False
+            instant = world.instant
             if self.verbose:
-                print('simulation step {}: {} users ({} completed), {} interactions ({} completed)'.format(instant, len(world.users), len(world.completed), len(world.interactions), len(world.completedInteractions)))
+                print('simulation step {}: {} users ({} completed), {} interactions ({} completed)'.format(instant, len(world.users), world.getNCompletedUsers(), len(world.interactions), world.getNCompletedInteractions()))
             world.updateControlDevices(self.timeStep)
             # print(world.controlDevices[0].state, world.controlDevices[1].state, instant)
-            userNum = world.initUsers(instant, userNum, self.safetyDistance)
-            world.updateUsers(instant, analysisZone)
-            world.updateFirstUsers()
-            world.updateInteractions(instant, self.computeInteractions)
-            instant += 1
+            world.userNum = world.initUsers(instant, world.userNum, self.safetyDistance)
+            if instant < world.nextInstant:  # the network is empty: only the users generated at instant may have to be updated
+                world.nextInstant = min(world.nextInstant, world.getNextInsertionInstant(instant-1))
+            if instant >= world.nextInstant:
+                world.updateUsers(instant, world.analysisZone)
+                world.updateFirstUsers()
+                world.updateInteractions(instant, self.computeInteractions)
+                if world.sink is not None:
+                    world.flushCompleted()
+                if world.eventDriven and world.isEmpty():
+                    world.nextInstant = world.getNextInsertionInstant(instant)
+            world.instant += 1
         world.duplicateLastVelocities()
-        world.computePET(self)
         world.computeMeanVelocities(self.timeStep)
+        if world.sink is not None:
+            world.flushCompleted()
+            world.flushRemaining()
+        return True
+
+    def getCheckpoint(self, world):
+        '''returns the checkpoint of the simulation in world (after start and resume until some instant):
+        binary pickle of the simulation, world (users, interactions, generators of the variates...)
+        and the state of the global numpy generator
+        the sink of world is not saved (see World.__getstate__)'''
+        return pickle.dumps((self, world, np.random.get_state()), protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def restoreCheckpoint(checkpoint):
+        '''returns the simulation and world of checkpoint (see getCheckpoint) and restores the state of the global numpy generator
+        the simulation is continued by sim.resume(world): each restoration is an independent copy,
+        so that several variants can be forked from the same checkpoint
+        (eg with other control devices or distributions, modified before resume)'''
+        sim, world, randomState = pickle.loads(checkpoint)
+        np.random.set_state(randomState)
+        return sim, world
+
+    def saveCheckpoint(self, world, filename):
+        '''saves the checkpoint of the simulation in world to file filename (see getCheckpoint)'''
+        with open(filename, 'wb') as f:
+            f.write(self.getCheckpoint(world))
+
+    @staticmethod
+    def loadCheckpoint(filename):
+        '''returns the simulation and world saved in file filename (see saveCheckpoint and restoreCheckpoint)'''
+        with open(filename, 'rb') as f:
+            return Simulation.restoreCheckpoint(f.read())
 
 
+def runReplication(task):
+    '''runs a replication of the simulation for the seed in task
+    task is a tuple (sim, worldFilename, seed, surface, processResult)'''
+    sim, worldFilename, seed, surface, processResult = task
+    sim = copy.copy(sim)
+    sim.seed = seed
+    world = network.World.load(worldFilename)
+    sim.run(world, surface)
+    if processResult is None:
+        return world
+    else:
+        return processResult(world, sim)
@@ -46,6 +46,19 @@ def deleteElementFromYaml(filename, key):
         print("the key requested does not exist in the yaml file")
 
 
+def setSqlitePragmas(connection, journalMode=None, synchronous=None):
+    """sets the journal mode (eg 'WAL') and synchronous level (eg 'NORMAL' or 'OFF')
+    of a sqlite connection, to speed up bulk exports"""
+    if journalMode is not None:
+        if journalMode.upper() not in ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']:
+            raise ValueError('unknown journal mode {}'.format(journalMode))
+        connection.execute('PRAGMA journal_mode = {}'.format(journalMode.upper()))
+    if synchronous is not None:
+        if str(synchronous).upper() not in ['0', '1', '2', '3', 'OFF', 'NORMAL', 'FULL', 'EXTRA']:
+            raise ValueError('unknown synchronous level {}'.format(synchronous))
+        connection.execute('PRAGMA synchronous = {}'.format(str(synchronous).upper()))
+
+
 def generateDistribution(dataFile):
     """generates a distribution from a set of data"""
     'input : csv file'